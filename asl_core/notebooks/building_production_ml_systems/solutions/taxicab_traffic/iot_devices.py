@@ -1,20 +1,171 @@
 """
 Send sensor data to Cloud Pub/Sub in small groups, simulating real-time
 behavior
+
+With --rate, publish JSON trips at a target rate instead, to load test the
+streaming pipeline. Setting --emulator_host (or PUBSUB_EMULATOR_HOST)
+publishes to the Pub/Sub emulator.
 """
 
 import argparse
+import json
 import logging
+import os
 import random
+import threading
 import time
+import uuid
 
 from google import api_core
 from google.cloud import pubsub
+from google.cloud.pubsub_v1 import types
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 DEFAULT_TOPIC = "taxi_rides"
+ZONES = [
+    "Midtown",
+    "Upper East Side",
+    "Upper West Side",
+    "Chelsea",
+    "Financial District",
+    "Harlem",
+    "JFK Airport",
+    "LaGuardia Airport",
+]
+VENDORS = ["CMT", "VTS"]
+NUM_VEHICLES = 13000
 
-if __name__ == "__main__":
+
+def make_trip(rng):
+    """Returns the JSON payload and attributes of a fake trip"""
+    now = time.time()
+    trip = {
+        "ride_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "vehicle_id": f"taxi-{rng.randrange(NUM_VEHICLES):05d}",
+        "vendor_id": rng.choice(VENDORS),
+        "zone": rng.choice(ZONES),
+        "passenger_count": rng.randint(1, 6),
+        "trip_duration_s": round(rng.lognormvariate(6.5, 0.6), 1),
+        "event_time": time.strftime(TIME_FORMAT, time.gmtime(now)),
+    }
+    # Read by streaming_count.py with --timestamp_attribute event_time
+    attributes = {"event_time": str(int(now * 1000))}
+    return json.dumps(trip).encode("utf-8"), attributes
+
+
+class PublishStats:
+    """Thread-safe counts and latencies of completed publish calls"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+        self.latencies = []
+
+    def record(self, future, start):
+        latency = time.perf_counter() - start
+        with self.lock:
+            if future.exception() is None:
+                self.published += 1
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+
+    def flush(self):
+        """Returns and resets the stats since the previous flush"""
+        with self.lock:
+            published, failed, latencies = (
+                self.published,
+                self.failed,
+                self.latencies,
+            )
+            self.published, self.failed, self.latencies = 0, 0, []
+        return published, failed, sorted(latencies)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def publish_at_rate(publisher, topic_name, rate, stop_time, stats, seed):
+    """Publishes trips on a fixed schedule of `rate` messages per second"""
+    rng = random.Random(seed)
+    interval = 1.0 / rate
+    next_time = time.perf_counter()
+    while next_time < stop_time:
+        data, attributes = make_trip(rng)
+        start = time.perf_counter()
+        # Blocks when the flow control limits are reached.
+        future = publisher.publish(topic_name, data, **attributes)
+        future.add_done_callback(
+            lambda future, start=start: stats.record(future, start)
+        )
+        next_time += interval
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_test(publisher, topic_name, args):
+    stats = PublishStats()
+    start = time.perf_counter()
+    stop_time = start + args.duration if args.duration else float("inf")
+    threads = [
+        threading.Thread(
+            target=publish_at_rate,
+            args=(
+                publisher,
+                topic_name,
+                args.rate / args.num_threads,
+                stop_time,
+                stats,
+                args.seed + thread_id,
+            ),
+            daemon=True,
+        )
+        for thread_id in range(args.num_threads)
+    ]
+    for thread in threads:
+        thread.start()
+
+    total_published = 0
+    total_failed = 0
+    last_report = start
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(args.report_interval)
+        published, failed, latencies = stats.flush()
+        now = time.perf_counter()
+        total_published += published
+        total_failed += failed
+        logging.info(
+            "%.0f msgs/sec (target %.0f), publish latency p50 %.1f ms "
+            "p99 %.1f ms, %d failed",
+            published / (now - last_report),
+            args.rate,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            failed,
+        )
+        last_report = now
+
+    # Sends the pending batches before reporting the totals.
+    publisher.stop()
+    published, failed, _ = stats.flush()
+    total_published += published
+    total_failed += failed
+    elapsed = time.perf_counter() - start
+    logging.info(
+        "Published %d messages in %.1fs (%.0f msgs/sec), %d failed",
+        total_published,
+        elapsed,
+        total_published / elapsed,
+        total_failed,
+    )
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--project", help="Google Cloud Project ID", required=True
@@ -24,11 +175,82 @@ if __name__ == "__main__":
         help="Pub/Sub Topic, will be created if doesn't exist",
         default=DEFAULT_TOPIC,
     )
+    parser.add_argument(
+        "--rate",
+        help="Target messages per second of JSON trips. 0 publishes small "
+        "groups of 'taxi_ride' messages every 5 seconds",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to publish at --rate for, 0 runs until interrupted",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--num_threads",
+        help="Number of publishing threads sharing the --rate",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--max_messages",
+        help="Maximum number of messages per publish request",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--max_bytes",
+        help="Maximum size in bytes of a publish request",
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "--max_latency",
+        help="Seconds a message waits for its batch to fill",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--max_outstanding_messages",
+        help="Publishing blocks while this many messages are unacknowledged",
+        type=int,
+        default=50000,
+    )
+    parser.add_argument(
+        "--report_interval",
+        help="Seconds between throughput and latency reports",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--emulator_host",
+        help="host:port of a Pub/Sub emulator to publish to",
+        default=None,
+    )
+    parser.add_argument(
+        "--seed", help="Seed of the generated trips", type=int, default=42
+    )
     args = parser.parse_args()
 
     # create Pub/Sub notification topic
     logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
-    publisher = pubsub.PublisherClient()
+    if args.emulator_host:
+        os.environ["PUBSUB_EMULATOR_HOST"] = args.emulator_host
+    publisher = pubsub.PublisherClient(
+        batch_settings=types.BatchSettings(
+            max_messages=args.max_messages,
+            max_bytes=args.max_bytes,
+            max_latency=args.max_latency,
+        ),
+        publisher_options=types.PublisherOptions(
+            flow_control=types.PublishFlowControl(
+                message_limit=args.max_outstanding_messages,
+                limit_exceeded_behavior=types.LimitExceededBehavior.BLOCK,
+            )
+        ),
+    )
     topic_name = publisher.topic_path(args.project, args.topic)
     try:
         publisher.get_topic(topic_name)
@@ -37,9 +259,16 @@ if __name__ == "__main__":
         publisher.create_topic(topic_name)
         logging.info("Creating pub/sub topic %s", args.topic)
 
-    while True:
-        num_trips = random.randint(10, 60)
-        for i in range(num_trips):
-            publisher.publish(topic_name, b"taxi_ride")
-        logging.info("Publishing: %s", time.ctime())
-        time.sleep(5)
+    if args.rate:
+        load_test(publisher, topic_name, args)
+    else:
+        while True:
+            num_trips = random.randint(10, 60)
+            for _ in range(num_trips):
+                publisher.publish(topic_name, b"taxi_ride")
+            logging.info("Publishing: %s", time.ctime())
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()
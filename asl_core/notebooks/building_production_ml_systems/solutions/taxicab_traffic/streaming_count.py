@@ -1,17 +1,29 @@
 """A streaming dataflow pipeline to count pub/sub messages."""
 
 import argparse
+import hashlib
+import json
 import logging
-from datetime import datetime
+import math
+import os
+import random
+import sqlite3
+import time
+import uuid
+from typing import Any, Dict, Tuple
 
 import apache_beam as beam
+import numpy as np
+import pyarrow
+from apache_beam.metrics import Metrics
 from apache_beam.options.pipeline_options import (
     GoogleCloudOptions,
     PipelineOptions,
     SetupOptions,
     StandardOptions,
 )
-from apache_beam.transforms import window  # pylint: disable=unused-import
+from apache_beam.transforms import trigger, window
+from pyarrow import parquet
 
 
 class CountFn(beam.CombineFn):
@@ -31,8 +43,609 @@ class CountFn(beam.CombineFn):
         return count
 
 
-def run(argv=None):
-    """Build and run the pipeline."""
+class HyperLogLogFn(beam.CombineFn):
+    """Approximate distinct count with a HyperLogLog sketch
+
+    The accumulator holds 2**precision one-byte registers, e.g. 4 KB and a
+    relative error around 1.6% for the default precision of 12. As in
+    HLL++, values are hashed to 64 bits, so large cardinalities need no
+    correction, and small ones are estimated by linear counting.
+    """
+
+    def __init__(self, precision=12):
+        super().__init__()
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision must be in [4, 18], got {precision}")
+        self.precision = precision
+
+    def create_accumulator(self):
+        return np.zeros(2**self.precision, dtype=np.uint8)
+
+    def add_input(self, registers, element):
+        if element is None:
+            return registers
+        digest = hashlib.blake2b(str(element).encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        # The first bits select the register, the others give the rank of
+        # their leftmost one bit.
+        num_bits = 64 - self.precision
+        index = value >> num_bits
+        rank = num_bits - (value & ((1 << num_bits) - 1)).bit_length() + 1
+        registers[index] = max(registers[index], rank)
+        return registers
+
+    def merge_accumulators(self, accumulators):
+        accumulators = iter(accumulators)
+        registers = next(accumulators)
+        for other in accumulators:
+            np.maximum(registers, other, out=registers)
+        return registers
+
+    def extract_output(self, registers):
+        num_registers = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = (
+            alpha
+            * num_registers**2
+            / np.sum(np.ldexp(1.0, -registers.astype(np.int32)))
+        )
+        num_zeros = int(np.count_nonzero(registers == 0))
+        if estimate <= 2.5 * num_registers and num_zeros:
+            estimate = num_registers * math.log(num_registers / num_zeros)
+        return int(round(estimate))
+
+
+class KllSketch:
+    """Mergeable KLL quantile sketch of at most about 3 * k values
+
+    Level h holds values standing for 2**h inputs each. A full level is
+    sorted and every other value, starting at random, moves up a level.
+    """
+
+    def __init__(self, k=200):
+        self.k = k
+        self.levels = [[]]
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def size(self):
+        return sum(len(values) for values in self.levels)
+
+    def max_size(self):
+        return sum(self.capacity(level) for level in range(len(self.levels)))
+
+    def compact(self):
+        while self.size() >= self.max_size():
+            for level, values in enumerate(self.levels):
+                if len(values) >= self.capacity(level):
+                    break
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            values.sort()
+            # An odd value out stays on its level.
+            kept = [values.pop()] if len(values) % 2 else []
+            self.levels[level + 1].extend(values[random.randint(0, 1) :: 2])
+            self.levels[level] = kept
+
+    def update(self, value):
+        self.levels[0].append(value)
+        self.compact()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.compact()
+
+    def quantiles(self, fractions):
+        weighted = sorted(
+            (value, 2**level)
+            for level, values in enumerate(self.levels)
+            for value in values
+        )
+        if not weighted:
+            return [None for _ in fractions]
+        total = sum(weight for _, weight in weighted)
+        results = []
+        for fraction in fractions:
+            quantile = weighted[-1][0]
+            cumulative = 0
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= fraction * total:
+                    quantile = value
+                    break
+            results.append(quantile)
+        return results
+
+
+class KllQuantilesFn(beam.CombineFn):
+    """Approximate quantiles with a KLL sketch of constant size"""
+
+    def __init__(self, fractions=(0.5, 0.9, 0.99), k=200):
+        super().__init__()
+        self.fractions = fractions
+        self.k = k
+
+    def create_accumulator(self):
+        return KllSketch(self.k)
+
+    def add_input(self, sketch, element):
+        # Missing and non-numeric values, e.g. from malformed messages, are
+        # skipped.
+        if isinstance(element, (int, float)) and not isinstance(element, bool):
+            if math.isfinite(element):
+                sketch.update(float(element))
+        return sketch
+
+    def merge_accumulators(self, accumulators):
+        accumulators = iter(accumulators)
+        sketch = next(accumulators)
+        for other in accumulators:
+            sketch.merge(other)
+        return sketch
+
+    def extract_output(self, sketch):
+        return sketch.quantiles(self.fractions)
+
+
+def parse_keys(message, key_fields):
+    """Returns the values of `key_fields` in a JSON message payload"""
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    return tuple(str(payload.get(field, "unknown")) for field in key_fields)
+
+
+def build_trigger(early_firing_delay=0, late_firings=False):
+    """Watermark trigger with optional early and late firings"""
+    if not early_firing_delay and not late_firings:
+        return None
+    early = None
+    if early_firing_delay:
+        early = trigger.AfterProcessingTime(early_firing_delay)
+    late = trigger.AfterCount(1) if late_firings else None
+    return trigger.AfterWatermark(early=early, late=late)
+
+
+def parse_trip(message):
+    """Returns the vehicle id and trip duration of a JSON message payload"""
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    return payload.get("vehicle_id"), payload.get("trip_duration_s")
+
+
+class PartialCombineFn(beam.CombineFn):
+    """Outputs the accumulator of `combine_fn` instead of its result"""
+
+    def __init__(self, combine_fn):
+        super().__init__()
+        self.combine_fn = combine_fn
+
+    def create_accumulator(self):
+        return self.combine_fn.create_accumulator()
+
+    def add_input(self, accumulator, element):
+        return self.combine_fn.add_input(accumulator, element)
+
+    def merge_accumulators(self, accumulators):
+        return self.combine_fn.merge_accumulators(accumulators)
+
+    def extract_output(self, accumulator):
+        return accumulator
+
+
+class FinalCombineFn(PartialCombineFn):
+    """Merges the accumulators output by PartialCombineFn into a result"""
+
+    def add_input(self, accumulator, element):
+        return self.combine_fn.merge_accumulators([accumulator, element])
+
+    def extract_output(self, accumulator):
+        return self.combine_fn.extract_output(accumulator)
+
+
+class FanoutCombine(beam.PTransform):
+    """Combines each key, or all elements, over `fanout` random sub-keys
+
+    Elements are first combined per random sub-key, then the partial
+    accumulators are merged per key. Unlike `with_hot_key_fanout`, this
+    works with sliding windows.
+    """
+
+    def __init__(self, combine_fn, fanout, keyed):
+        super().__init__()
+        self.combine_fn = beam.CombineFn.maybe_from_callable(combine_fn)
+        self.fanout = fanout
+        self.keyed = keyed
+
+    def expand(self, pcoll):
+        fanout = self.fanout
+        if self.keyed:
+            salted = pcoll | "salt" >> beam.Map(
+                lambda kv: ((kv[0], random.randrange(fanout)), kv[1])
+            )
+        else:
+            salted = pcoll | "salt" >> beam.Map(
+                lambda value: (random.randrange(fanout), value)
+            )
+        partial = salted | "combine_salted" >> beam.CombinePerKey(
+            PartialCombineFn(self.combine_fn)
+        )
+        final_fn = FinalCombineFn(self.combine_fn)
+        if self.keyed:
+            return (
+                partial
+                | "unsalt" >> beam.Map(lambda kv: (kv[0][0], kv[1]))
+                | "combine" >> beam.CombinePerKey(final_fn)
+            )
+        return (
+            partial
+            | "unsalt" >> beam.Map(lambda kv: kv[1])
+            | "combine" >> beam.CombineGlobally(final_fn).without_defaults()
+        )
+
+
+class CountTrips(beam.PTransform):
+    """Counts messages in sliding windows of `window_size` seconds.
+
+    With `pane_aggregation`, messages are first counted in fixed panes of
+    `window_period` seconds and the sliding totals are sums of pane counts,
+    so each message is counted once instead of once per overlapping window.
+
+    With `key_fields`, messages are counted per tuple of payload fields and
+    the output is (key, count) pairs. `hot_key_fanout` spreads the combine
+    of each key, or of the global count, over that many intermediate keys.
+
+    `window_trigger`, `accumulation_mode` and `allowed_lateness` configure the
+    sliding windows. Panes fire with the same trigger but always discard,
+    so the sliding windows sum each message once. For the same reason, the
+    fanout needs discarding firings when a trigger is set.
+    """
+
+    def __init__(
+        self,
+        window_size=300,
+        window_period=15,
+        pane_aggregation=False,
+        key_fields=None,
+        hot_key_fanout=0,
+        window_trigger=None,
+        accumulation_mode=None,
+        allowed_lateness=0,
+    ):
+        super().__init__()
+        if window_size % window_period:
+            raise ValueError(
+                f"window_size ({window_size}) must be a multiple of "
+                f"window_period ({window_period})"
+            )
+        if (
+            hot_key_fanout
+            and window_trigger
+            and accumulation_mode == trigger.AccumulationMode.ACCUMULATING
+        ):
+            raise ValueError(
+                "hot_key_fanout requires the discarding accumulation mode"
+            )
+        self.window_size = window_size
+        self.window_period = window_period
+        self.pane_aggregation = pane_aggregation
+        self.key_fields = tuple(key_fields or ())
+        self.hot_key_fanout = hot_key_fanout
+        self.window_trigger = window_trigger
+        self.accumulation_mode = accumulation_mode
+        self.allowed_lateness = allowed_lateness
+
+    def combine(self, combine_fn, fanout=0):
+        if fanout:
+            return FanoutCombine(combine_fn, fanout, bool(self.key_fields))
+        if self.key_fields:
+            return beam.CombinePerKey(combine_fn)
+        return beam.CombineGlobally(combine_fn).without_defaults()
+
+    def expand(self, pcoll):
+        if self.key_fields:
+            key_fields = self.key_fields
+            pcoll = pcoll | "key" >> beam.Map(
+                lambda message: (parse_keys(message, key_fields), message)
+            )
+        combine_fn = CountFn()
+        if self.pane_aggregation:
+            pane_accumulation_mode = None
+            if self.window_trigger:
+                pane_accumulation_mode = trigger.AccumulationMode.DISCARDING
+            # Pane counts are timestamped at the end of their pane, which
+            # falls in the same sliding windows as the messages they count.
+            pcoll = (
+                pcoll
+                | "pane_window"
+                >> beam.WindowInto(
+                    window.FixedWindows(self.window_period),
+                    trigger=self.window_trigger,
+                    accumulation_mode=pane_accumulation_mode,
+                    allowed_lateness=self.allowed_lateness,
+                )
+                | "count_panes" >> self.combine(CountFn(), self.hot_key_fanout)
+            )
+            combine_fn = sum
+        return (
+            pcoll
+            | "window"
+            >> beam.WindowInto(
+                window.SlidingWindows(
+                    size=self.window_size, period=self.window_period
+                ),
+                trigger=self.window_trigger,
+                accumulation_mode=self.accumulation_mode,
+                allowed_lateness=self.allowed_lateness,
+            )
+            # Pane counts are few, they need no fanout.
+            | "count"
+            >> self.combine(
+                combine_fn, 0 if self.pane_aggregation else self.hot_key_fanout
+            )
+        )
+
+
+class TripStats(CountTrips):
+    """Approximate unique vehicles and trip duration quantiles per window
+
+    Outputs (unique vehicles, duration quantiles) per sliding window, or
+    (key, (unique vehicles, duration quantiles)) pairs with `key_fields`.
+    Both sketches have a constant size whatever the number of messages.
+    """
+
+    def __init__(self, fractions=(0.5, 0.9, 0.99), **kwargs):
+        super().__init__(**kwargs)
+        self.fractions = fractions
+
+    def expand(self, pcoll):
+        key_fields = self.key_fields
+
+        def parse(message):
+            if key_fields:
+                return parse_keys(message, key_fields), parse_trip(message)
+            return parse_trip(message)
+
+        return (
+            pcoll
+            | "parse_trips" >> beam.Map(parse)
+            | "window"
+            >> beam.WindowInto(
+                window.SlidingWindows(
+                    size=self.window_size, period=self.window_period
+                ),
+                trigger=self.window_trigger,
+                accumulation_mode=self.accumulation_mode,
+                allowed_lateness=self.allowed_lateness,
+            )
+            | "sketch"
+            >> self.combine(
+                # Vehicle ids go to the first, durations to the second.
+                beam.combiners.TupleCombineFn(
+                    HyperLogLogFn(), KllQuantilesFn(self.fractions)
+                ),
+                self.hot_key_fanout,
+            )
+        )
+
+
+class WriteBatchFn(beam.DoFn):
+    """Writes batches of rows to a local sink and tracks the write time"""
+
+    def __init__(self, path, table):
+        super().__init__()
+        self.path = path
+        self.table = table
+        self.rows_written = Metrics.counter("sink", "rows_written")
+        self.write_msecs = Metrics.distribution("sink", "write_msecs")
+
+    def process(self, rows):
+        start = time.perf_counter()
+        self.write(rows)
+        self.write_msecs.update(int((time.perf_counter() - start) * 1000))
+        self.rows_written.inc(len(rows))
+
+    def write(self, rows):
+        raise NotImplementedError
+
+
+class WriteNdjsonFn(WriteBatchFn):
+    """Appends rows to a newline-delimited JSON file of its own"""
+
+    def setup(self):
+        os.makedirs(self.path, exist_ok=True)
+        filename = f"{self.table}-{uuid.uuid4().hex}.ndjson"
+        # pylint: disable=consider-using-with
+        self.file = open(
+            os.path.join(self.path, filename), "a", encoding="utf-8"
+        )
+
+    def write(self, rows):
+        self.file.write("".join(json.dumps(row) + "\n" for row in rows))
+        self.file.flush()
+
+    def teardown(self):
+        self.file.close()
+
+
+class WriteSqliteFn(WriteBatchFn):
+    """Inserts rows in a SQLite table, created from the first row"""
+
+    def setup(self):
+        self.connection = sqlite3.connect(self.path, timeout=60)
+
+    def write(self, rows):
+        columns = ", ".join(f'"{column}"' for column in rows[0])
+        values = ", ".join("?" for _ in rows[0])
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.table}" ({columns})'
+            )
+            self.connection.executemany(
+                f'INSERT INTO "{self.table}" ({columns}) VALUES ({values})',
+                [tuple(row.values()) for row in rows],
+            )
+
+    def teardown(self):
+        self.connection.close()
+
+
+class WriteParquetFn(WriteBatchFn):
+    """Writes each batch of rows to a new Parquet file in a directory"""
+
+    def setup(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, rows):
+        filename = f"{self.table}-{uuid.uuid4().hex}.parquet"
+        parquet.write_table(
+            pyarrow.Table.from_pylist(rows), os.path.join(self.path, filename)
+        )
+
+
+class WriteToLocalSink(beam.PTransform):
+    """Writes rows to a local sink in batches of up to `batch_size` rows
+
+    Rows are moved to the global window first, so that batches are not
+    limited to the rows of a single window. A batch is written at the
+    latest `flush_secs` seconds after its first row.
+    """
+
+    def __init__(self, sink, path, table, batch_size=500, flush_secs=10):
+        super().__init__()
+        self.write_fn = LOCAL_SINKS[sink](path, table)
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+
+    def expand(self, pcoll):
+        table = self.table
+        return (
+            pcoll
+            | "global_window" >> beam.WindowInto(window.GlobalWindows())
+            | "key_by_table"
+            >> beam.Map(lambda row: (table, row)).with_output_types(
+                Tuple[str, Dict[str, Any]]
+            )
+            | "batch_rows"
+            >> beam.GroupIntoBatches.WithShardedKey(
+                self.batch_size, max_buffering_duration_secs=self.flush_secs
+            )
+            | "drop_keys" >> beam.MapTuple(lambda _, rows: list(rows))
+            | "write" >> beam.ParDo(self.write_fn)
+        )
+
+
+LOCAL_SINKS = {
+    "ndjson": WriteNdjsonFn,
+    "parquet": WriteParquetFn,
+    "sqlite": WriteSqliteFn,
+}
+
+BQ_WRITE_METHODS = {
+    "streaming_inserts": beam.io.WriteToBigQuery.Method.STREAMING_INSERTS,
+    "storage_write_api": beam.io.WriteToBigQuery.Method.STORAGE_WRITE_API,
+    # The same method, with use_at_least_once set.
+    "storage_api_at_least_once": (
+        beam.io.WriteToBigQuery.Method.STORAGE_WRITE_API
+    ),
+}
+STATS_FRACTIONS = (0.5, 0.9, 0.99)
+# List prices in USD per GB, see https://cloud.google.com/bigquery/pricing
+STREAMING_INSERTS_PRICE_PER_GB = 0.05
+STORAGE_WRITE_API_PRICE_PER_GB = 0.025
+STORAGE_WRITE_API_FREE_GB_PER_MONTH = 2048
+
+
+def output_row_bytes(num_key_fields=0, trip_stats=False):
+    """Approximate BigQuery size of a row of each output table"""
+    # INTEGER, FLOAT and TIMESTAMP columns take 8 bytes, a short STRING key
+    # around 14 bytes.
+    key_bytes = 14 * num_key_fields
+    row_bytes = [key_bytes + 16]
+    if trip_stats:
+        row_bytes.append(key_bytes + 16 + 8 * len(STATS_FRACTIONS))
+    return row_bytes
+
+
+def estimate_sink_cost(
+    write_method,
+    row_bytes,
+    num_keys=1,
+    window_period=15,
+    batch_size=500,
+    triggering_frequency=5,
+):
+    """Estimates the BigQuery requests and monthly cost of the outputs
+
+    `row_bytes` holds the size of a row of each output table. Each firing
+    writes a row per key to every output table.
+    """
+    rows_per_sec = 0
+    requests_per_sec = 0
+    gb_per_month = 0
+    for table_row_bytes in row_bytes:
+        rows_per_sec += num_keys / window_period
+        if write_method == "streaming_inserts":
+            # Rows of a firing are sent together, in requests of batch_size.
+            requests_per_sec += math.ceil(num_keys / batch_size) / window_period
+            # Streaming inserts bill each row as at least 1 KB.
+            table_row_bytes = max(table_row_bytes, 1024)
+        elif write_method == "storage_write_api":
+            requests_per_sec += 1 / max(triggering_frequency, window_period)
+        else:
+            # The at least once mode appends rows as they come.
+            requests_per_sec += 1 / window_period
+        gb_per_month += (
+            num_keys / window_period * table_row_bytes * 30 * 24 * 3600 / 1e9
+        )
+
+    if write_method == "streaming_inserts":
+        cost = gb_per_month * STREAMING_INSERTS_PRICE_PER_GB
+    else:
+        billed_gb = max(0.0, gb_per_month - STORAGE_WRITE_API_FREE_GB_PER_MONTH)
+        cost = billed_gb * STORAGE_WRITE_API_PRICE_PER_GB
+    return {
+        "write_method": write_method,
+        "rows_per_sec": rows_per_sec,
+        "requests_per_sec": requests_per_sec,
+        "rows_per_request": rows_per_sec / requests_per_sec,
+        "billed_gb_per_month": gb_per_month,
+        "usd_per_month": cost,
+    }
+
+
+def bigquery_write_options(known_args, key_fields, schema):
+    """Keyword arguments of WriteToBigQuery for the --bq_write_method"""
+    write_options = {"method": BQ_WRITE_METHODS[known_args.bq_write_method]}
+    if known_args.bq_write_method == "streaming_inserts":
+        write_options["batch_size"] = known_args.bq_batch_size
+        return write_options
+    # Rows are converted with the schema for the Storage Write API.
+    write_options["schema"] = ",".join(
+        [f"{field}:STRING" for field in key_fields] + schema
+    )
+    if known_args.bq_write_method == "storage_api_at_least_once":
+        write_options["use_at_least_once"] = True
+    else:
+        write_options["triggering_frequency"] = known_args.triggering_frequency
+    return write_options
+
+
+def parse_args(argv=None):
+    """Parse the pipeline arguments."""
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -44,8 +657,282 @@ def run(argv=None):
         help=("Google Cloud PubSub topic name "),
         required=True,
     )
+    parser.add_argument(
+        "--pane_aggregation",
+        help=(
+            "Count messages in 15 second panes and sum the panes into the "
+            "5 minute sliding counts"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--key_fields",
+        help=(
+            "Comma separated JSON payload fields to count by, e.g. "
+            "'zone,vendor_id'. The output table needs a column per field"
+        ),
+        default="",
+    )
+    parser.add_argument(
+        "--hot_key_fanout",
+        help="Number of intermediate keys each count is combined over",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--output_table",
+        help=(
+            "Table of the taxifare dataset to write counts to, also the "
+            "SQLite table and the file prefix of the other local sinks"
+        ),
+        default="traffic_realtime",
+    )
+    parser.add_argument(
+        "--timestamp_attribute",
+        help=(
+            "Message attribute holding the event time, in milliseconds since "
+            "the epoch or RFC 3339. Defaults to the publish time"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--allowed_lateness",
+        help="Seconds after the watermark during which late messages count",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--early_firing_delay",
+        help=(
+            "Emit early counts this many seconds after the first message of "
+            "a window, before the watermark closes it. 0 disables them"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--late_firings",
+        help="Emit an updated count for each late message",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--accumulation_mode",
+        help=(
+            "Whether repeated firings of a window emit the running total or "
+            "only the messages since the previous firing"
+        ),
+        choices=["accumulating", "discarding"],
+        default="discarding",
+    )
+    parser.add_argument(
+        "--trip_stats",
+        help=(
+            "Also write approximate unique vehicles and trip duration "
+            "percentiles per window to --stats_table"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats_table",
+        help="Table of the taxifare dataset to write trip stats to",
+        default="traffic_stats_realtime",
+    )
+    parser.add_argument(
+        "--sink",
+        help="Where to write the counts. Local sinks need --sink_path",
+        choices=["bigquery"] + sorted(LOCAL_SINKS),
+        default="bigquery",
+    )
+    parser.add_argument(
+        "--sink_path",
+        help=(
+            "Database file of the sqlite sink, directory of the ndjson and "
+            "parquet sinks"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--sink_batch_size",
+        help="Maximum number of rows per local sink write",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--sink_flush_secs",
+        help="Maximum seconds a row waits for its local sink batch to fill",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--bq_write_method",
+        help=(
+            "BigQuery write method. The Storage Write API modes write "
+            "exactly once or at least once"
+        ),
+        choices=sorted(BQ_WRITE_METHODS),
+        default="streaming_inserts",
+    )
+    parser.add_argument(
+        "--bq_batch_size",
+        help="Maximum number of rows per streaming insert request",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--triggering_frequency",
+        help="Seconds between appends of the exactly once Storage Write API",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--expected_keys",
+        help="Expected number of keys per window, for the cost estimate",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--estimate_sink_cost",
+        help="Only log the estimated BigQuery requests and cost, then exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--wait_until_finish",
+        help="Block until the pipeline ends, e.g. with the DirectRunner",
+        action="store_true",
+    )
 
     known_args, pipeline_args = parser.parse_known_args(argv)
+    if known_args.sink != "bigquery" and not known_args.sink_path:
+        parser.error(f"--sink {known_args.sink} requires --sink_path")
+    if known_args.sink != "bigquery" and known_args.estimate_sink_cost:
+        parser.error("--estimate_sink_cost requires --sink bigquery")
+    known_args.key_fields = [
+        field for field in known_args.key_fields.split(",") if field
+    ]
+    return known_args, pipeline_args
+
+
+def build_pipeline(p, known_args):
+    """Add the steps reading, counting and writing the trips to `p`."""
+    topic = f"projects/{known_args.project}/topics/{known_args.input_topic}"
+    # the output tables need to exist
+    accumulation_mode = {
+        "accumulating": trigger.AccumulationMode.ACCUMULATING,
+        "discarding": trigger.AccumulationMode.DISCARDING,
+    }[known_args.accumulation_mode]
+    key_fields = known_args.key_fields
+
+    # The Storage Write API takes TIMESTAMP columns as Beam timestamps.
+    timestamp_as_string = known_args.sink != "bigquery" or (
+        known_args.bq_write_method == "streaming_inserts"
+    )
+
+    def window_row(key, fields, win):
+        row = dict(zip(key_fields, key)) if key_fields else {}
+        row.update(fields)
+        # End of the window, so that reruns produce the same rows.
+        row["time"] = (
+            win.end.to_utc_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            if timestamp_as_string
+            else win.end
+        )
+        return row
+
+    def to_bq_format(element, win=beam.DoFn.WindowParam):
+        """BigQuery writer requires rows to be stored as python dictionary"""
+        key, count = element if key_fields else (None, element)
+        return window_row(key, {"trips_last_5min": count}, win)
+
+    def to_stats_format(element, win=beam.DoFn.WindowParam):
+        key, (unique_vehicles, durations) = (
+            element if key_fields else (None, element)
+        )
+        fields = {"unique_vehicles": unique_vehicles}
+        for fraction, duration in zip(STATS_FRACTIONS, durations):
+            fields[f"trip_duration_p{round(fraction * 100)}"] = duration
+        return window_row(key, fields, win)
+
+    def write_rows(rows, table, schema, prefix=""):
+        if known_args.sink == "bigquery":
+            return rows | f"{prefix}write_to_bq" >> beam.io.WriteToBigQuery(
+                f"{known_args.project}:taxifare.{table}",
+                # WRITE_TRUNCATE not supported for streaming
+                write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+                create_disposition=beam.io.BigQueryDisposition.CREATE_NEVER,
+                **bigquery_write_options(known_args, key_fields, schema),
+            )
+        return rows | f"{prefix}write_to_{known_args.sink}" >> WriteToLocalSink(
+            known_args.sink,
+            known_args.sink_path,
+            table,
+            batch_size=known_args.sink_batch_size,
+            flush_secs=known_args.sink_flush_secs,
+        )
+
+    window_options = {
+        "window_size": 300,
+        "window_period": 15,
+        "key_fields": key_fields,
+        "hot_key_fanout": known_args.hot_key_fanout,
+        "window_trigger": build_trigger(
+            known_args.early_firing_delay, known_args.late_firings
+        ),
+        "accumulation_mode": accumulation_mode,
+        "allowed_lateness": known_args.allowed_lateness,
+    }
+    messages = p | "read_from_pubsub" >> beam.io.ReadFromPubSub(
+        topic=topic, timestamp_attribute=known_args.timestamp_attribute
+    ).with_output_types(bytes)
+
+    rows = (
+        messages
+        | "count"
+        >> CountTrips(
+            pane_aggregation=known_args.pane_aggregation, **window_options
+        )
+        | "format_for_bq" >> beam.Map(to_bq_format)
+    )
+    write_rows(
+        rows,
+        known_args.output_table,
+        ["trips_last_5min:INTEGER", "time:TIMESTAMP"],
+    )
+
+    if known_args.trip_stats:
+        stats = (
+            messages
+            | "trip_stats"
+            >> TripStats(fractions=STATS_FRACTIONS, **window_options)
+            | "format_stats" >> beam.Map(to_stats_format)
+        )
+        write_rows(
+            stats,
+            known_args.stats_table,
+            ["unique_vehicles:INTEGER"]
+            + [
+                f"trip_duration_p{round(fraction * 100)}:FLOAT"
+                for fraction in STATS_FRACTIONS
+            ]
+            + ["time:TIMESTAMP"],
+            prefix="stats_",
+        )
+
+
+def run(argv=None):
+    """Build and run the pipeline."""
+    known_args, pipeline_args = parse_args(argv)
+
+    if known_args.sink == "bigquery":
+        estimate = estimate_sink_cost(
+            known_args.bq_write_method,
+            output_row_bytes(len(known_args.key_fields), known_args.trip_stats),
+            num_keys=known_args.expected_keys,
+            batch_size=known_args.bq_batch_size,
+            triggering_frequency=known_args.triggering_frequency,
+        )
+        logging.info("Estimated BigQuery sink cost: %s", estimate)
+        if known_args.estimate_sink_cost:
+            return
 
     pipeline_options = PipelineOptions(pipeline_args)
     pipeline_options.view_as(SetupOptions).save_main_session = True
@@ -54,37 +941,12 @@ def run(argv=None):
     pipeline_options.view_as(GoogleCloudOptions).project = known_args.project
 
     p = beam.Pipeline(options=pipeline_options)
+    build_pipeline(p, known_args)
 
-    topic = f"projects/{known_args.project}/topics/{known_args.input_topic}"
-    # this table needs to exist
-    table_spec = f"{known_args.project}:taxifare.traffic_realtime"
-
-    def to_bq_format(count):
-        """BigQuery writer requires rows to be stored as python dictionary"""
-        return {
-            "trips_last_5min": count,
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        }
-
-    pipeline = (  # noqa F841 pylint: disable=unused-variable
-        p
-        | "read_from_pubsub"
-        >> beam.io.ReadFromPubSub(topic=topic).with_output_types(bytes)
-        | "window"
-        >> beam.WindowInto(window.SlidingWindows(size=300, period=15))
-        | "count" >> beam.CombineGlobally(CountFn()).without_defaults()
-        | "format_for_bq" >> beam.Map(to_bq_format)
-        | "write_to_bq"
-        >> beam.io.WriteToBigQuery(
-            table_spec,
-            # WRITE_TRUNCATE not supported for streaming
-            write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-            create_disposition=beam.io.BigQueryDisposition.CREATE_NEVER,
-        )
-    )
-
-    result = p.run()  # noqa F841 pylint: disable=unused-variable
-    # result.wait_until_finish() #only do this if running with DirectRunner
+    result = p.run()
+    if known_args.wait_until_finish:
+        # only do this if running with DirectRunner
+        result.wait_until_finish()
 
 
 if __name__ == "__main__":
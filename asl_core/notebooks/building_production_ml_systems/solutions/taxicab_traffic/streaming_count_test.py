@@ -0,0 +1,377 @@
+"""Tests of the streaming pub/sub message counting pipeline."""
+
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import apache_beam as beam
+import streaming_count
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.test_stream import TestStream
+from apache_beam.testing.util import assert_that, equal_to
+from apache_beam.transforms import trigger, window
+from apache_beam.transforms.window import TimestampedValue
+
+REQUIRED_ARGS = [
+    "--project=test-project",
+    "--region=us-central1",
+    "--input_topic=taxi_rides",
+]
+
+
+def build_pipeline(*args):
+    known_args, _ = streaming_count.parse_args(REQUIRED_ARGS + list(args))
+    p = beam.Pipeline(options=PipelineOptions(streaming=True))
+    streaming_count.build_pipeline(p, known_args)
+    return p
+
+
+class BuildPipelineTest(unittest.TestCase):
+    def test_default_pipeline(self):
+        build_pipeline()
+
+    def test_keyed_pipeline_with_fanout(self):
+        args = ["--key_fields=zone,vendor_id", "--hot_key_fanout=4"]
+        build_pipeline(*args)
+        build_pipeline(*args, "--pane_aggregation")
+        build_pipeline("--hot_key_fanout=4", "--trip_stats")
+
+    def test_local_sinks(self):
+        for sink in streaming_count.LOCAL_SINKS:
+            with self.subTest(sink=sink), tempfile.TemporaryDirectory() as tmp:
+                build_pipeline(f"--sink={sink}", f"--sink_path={tmp}/out")
+
+    def test_bigquery_write_options(self):
+        method = beam.io.WriteToBigQuery.Method
+        schema = ["trips_last_5min:INTEGER", "time:TIMESTAMP"]
+        known_args, _ = streaming_count.parse_args(REQUIRED_ARGS)
+        self.assertEqual(
+            streaming_count.bigquery_write_options(known_args, [], schema),
+            {"method": method.STREAMING_INSERTS, "batch_size": 500},
+        )
+
+        known_args, _ = streaming_count.parse_args(
+            REQUIRED_ARGS + ["--bq_write_method=storage_write_api"]
+        )
+        self.assertEqual(
+            streaming_count.bigquery_write_options(
+                known_args, ["zone"], schema
+            ),
+            {
+                "method": method.STORAGE_WRITE_API,
+                "schema": "zone:STRING,trips_last_5min:INTEGER,time:TIMESTAMP",
+                "triggering_frequency": 5,
+            },
+        )
+
+        known_args, _ = streaming_count.parse_args(
+            REQUIRED_ARGS + ["--bq_write_method=storage_api_at_least_once"]
+        )
+        options = streaming_count.bigquery_write_options(known_args, [], schema)
+        self.assertEqual(options["method"], method.STORAGE_WRITE_API)
+        self.assertTrue(options["use_at_least_once"])
+        self.assertNotIn("triggering_frequency", options)
+
+
+def with_window_start(element, win=beam.DoFn.WindowParam):
+    return float(win.start), element
+
+
+def sliding_counts(timestamps, size=300, period=15):
+    """Expected (window start, count) of messages at `timestamps`"""
+    counts = {}
+    for timestamp in timestamps:
+        last_start = timestamp - timestamp % period
+        for start in range(last_start - size + period, last_start + 1, period):
+            counts[float(start)] = counts.get(float(start), 0) + 1
+    return sorted(counts.items())
+
+
+def message_stream(timestamps, payload=b"taxi_ride"):
+    return (
+        TestStream()
+        .add_elements(
+            [TimestampedValue(payload, timestamp) for timestamp in timestamps]
+        )
+        .advance_watermark_to_infinity()
+    )
+
+
+def streaming_pipeline():
+    return TestPipeline(options=PipelineOptions(streaming=True))
+
+
+class CountTripsTest(unittest.TestCase):
+    TIMESTAMPS = [0, 1, 14, 15, 29, 100, 299, 300, 301, 620, 620, 900]
+
+    def test_pane_aggregation_matches_sliding_count(self):
+        expected = sliding_counts(self.TIMESTAMPS)
+        for pane_aggregation in [False, True]:
+            with self.subTest(pane_aggregation=pane_aggregation):
+                with streaming_pipeline() as p:
+                    counts = (
+                        p
+                        | message_stream(self.TIMESTAMPS)
+                        | streaming_count.CountTrips(
+                            pane_aggregation=pane_aggregation
+                        )
+                        | beam.Map(with_window_start)
+                    )
+                    assert_that(counts, equal_to(expected))
+
+    def test_hot_key_fanout(self):
+        expected = sliding_counts(self.TIMESTAMPS)
+        for pane_aggregation in [False, True]:
+            with self.subTest(pane_aggregation=pane_aggregation):
+                with streaming_pipeline() as p:
+                    counts = (
+                        p
+                        | message_stream(self.TIMESTAMPS)
+                        | streaming_count.CountTrips(
+                            pane_aggregation=pane_aggregation,
+                            hot_key_fanout=4,
+                        )
+                        | beam.Map(with_window_start)
+                    )
+                    assert_that(counts, equal_to(expected))
+
+    def test_keyed_counts_with_fanout(self):
+        timestamps = {"Midtown": [0, 20, 40], "Harlem": [10, 310]}
+        messages = [
+            TimestampedValue(json.dumps({"zone": zone}).encode(), ts)
+            for zone, zone_timestamps in timestamps.items()
+            for ts in zone_timestamps
+        ] + [TimestampedValue(b"taxi_ride", 30)]
+        timestamps["unknown"] = [30]
+        expected = [
+            ((zone,), start, count)
+            for zone, zone_timestamps in timestamps.items()
+            for start, count in sliding_counts(zone_timestamps)
+        ]
+
+        for pane_aggregation in [False, True]:
+            with self.subTest(pane_aggregation=pane_aggregation):
+                with streaming_pipeline() as p:
+                    counts = (
+                        p
+                        | TestStream()
+                        .add_elements(messages)
+                        .advance_watermark_to_infinity()
+                        | streaming_count.CountTrips(
+                            pane_aggregation=pane_aggregation,
+                            key_fields=["zone"],
+                            hot_key_fanout=3,
+                        )
+                        | beam.Map(with_window_start)
+                        | beam.MapTuple(lambda start, kv: (kv[0], start, kv[1]))
+                    )
+                    assert_that(counts, equal_to(expected))
+
+    def test_fanout_rejects_accumulating_firings(self):
+        with self.assertRaises(ValueError):
+            streaming_count.CountTrips(
+                hot_key_fanout=4,
+                window_trigger=streaming_count.build_trigger(late_firings=True),
+                accumulation_mode=trigger.AccumulationMode.ACCUMULATING,
+            )
+
+
+class EstimateSinkCostTest(unittest.TestCase):
+    def test_trip_stats_rows_are_counted(self):
+        counts = streaming_count.estimate_sink_cost(
+            "streaming_inserts",
+            streaming_count.output_row_bytes(),
+            num_keys=40,
+        )
+        with_stats = streaming_count.estimate_sink_cost(
+            "streaming_inserts",
+            streaming_count.output_row_bytes(trip_stats=True),
+            num_keys=40,
+        )
+        self.assertAlmostEqual(with_stats["rows_per_sec"], 2 * 40 / 15)
+        self.assertAlmostEqual(
+            with_stats["rows_per_sec"], 2 * counts["rows_per_sec"]
+        )
+        self.assertAlmostEqual(
+            with_stats["requests_per_sec"], 2 * counts["requests_per_sec"]
+        )
+        self.assertEqual(with_stats["rows_per_request"], 40)
+
+    def test_rows_per_storage_write_api_request(self):
+        estimate = streaming_count.estimate_sink_cost(
+            "storage_write_api",
+            streaming_count.output_row_bytes(),
+            num_keys=40,
+            triggering_frequency=60,
+        )
+        self.assertAlmostEqual(estimate["rows_per_request"], 160)
+        self.assertEqual(estimate["usd_per_month"], 0)
+
+    def test_estimate_requires_bigquery_sink(self):
+        with self.assertRaises(SystemExit):
+            streaming_count.parse_args(
+                REQUIRED_ARGS
+                + ["--sink=sqlite", "--sink_path=x", "--estimate_sink_cost"]
+            )
+
+
+class LateDataTest(unittest.TestCase):
+    def assert_late_data_counts(self, expected, **count_options):
+        # The message at 3 arrives after the watermark passed its window.
+        stream = (
+            TestStream()
+            .add_elements([TimestampedValue(b"taxi_ride", ts) for ts in [1, 2]])
+            .advance_watermark_to(20)
+            .add_elements([TimestampedValue(b"taxi_ride", 3)])
+            .advance_watermark_to_infinity()
+        )
+        with streaming_pipeline() as p:
+            counts = (
+                p
+                | stream
+                | streaming_count.CountTrips(
+                    window_size=15, window_period=15, **count_options
+                )
+                | beam.Map(with_window_start)
+            )
+            assert_that(counts, equal_to(expected))
+
+    def test_late_message_is_dropped_by_default(self):
+        self.assert_late_data_counts([(0.0, 2)])
+
+    def test_late_firing_accumulating(self):
+        self.assert_late_data_counts(
+            [(0.0, 2), (0.0, 3)],
+            window_trigger=streaming_count.build_trigger(late_firings=True),
+            accumulation_mode=trigger.AccumulationMode.ACCUMULATING,
+            allowed_lateness=60,
+        )
+
+    def test_late_firing_discarding(self):
+        self.assert_late_data_counts(
+            [(0.0, 2), (0.0, 1)],
+            window_trigger=streaming_count.build_trigger(late_firings=True),
+            accumulation_mode=trigger.AccumulationMode.DISCARDING,
+            allowed_lateness=60,
+        )
+
+    def test_late_firing_with_pane_aggregation(self):
+        self.assert_late_data_counts(
+            [(0.0, 2), (0.0, 1)],
+            pane_aggregation=True,
+            window_trigger=streaming_count.build_trigger(late_firings=True),
+            accumulation_mode=trigger.AccumulationMode.DISCARDING,
+            allowed_lateness=60,
+        )
+
+
+class TripStatsTest(unittest.TestCase):
+    MESSAGES = [
+        {"vehicle_id": "taxi-1", "zone": "Midtown", "trip_duration_s": 100},
+        {"vehicle_id": "taxi-2", "zone": "Midtown", "trip_duration_s": 200.0},
+        {"vehicle_id": "taxi-1", "zone": "Midtown", "trip_duration_s": 300},
+        {"vehicle_id": "taxi-3", "zone": "Harlem", "trip_duration_s": 400},
+        {"vehicle_id": "taxi-3", "zone": "Harlem", "trip_duration_s": 500},
+        # Skipped by the quantiles, counted by the distinct vehicles.
+        {"vehicle_id": "taxi-4", "zone": "Harlem", "trip_duration_s": "n/a"},
+    ]
+
+    def message_stream(self):
+        messages = [
+            TimestampedValue(json.dumps(message).encode(), ts)
+            for ts, message in enumerate(self.MESSAGES)
+        ]
+        # Neither a vehicle nor a duration.
+        messages.append(TimestampedValue(b"taxi_ride", 10))
+        return (
+            TestStream().add_elements(messages).advance_watermark_to_infinity()
+        )
+
+    def test_global_stats(self):
+        for hot_key_fanout in [0, 3]:
+            with self.subTest(hot_key_fanout=hot_key_fanout):
+                with streaming_pipeline() as p:
+                    stats = (
+                        p
+                        | self.message_stream()
+                        | streaming_count.TripStats(
+                            window_size=300,
+                            window_period=300,
+                            hot_key_fanout=hot_key_fanout,
+                        )
+                    )
+                    assert_that(stats, equal_to([(4, [300.0, 500.0, 500.0])]))
+
+    def test_keyed_stats(self):
+        with streaming_pipeline() as p:
+            stats = (
+                p
+                | self.message_stream()
+                | streaming_count.TripStats(
+                    window_size=300, window_period=300, key_fields=["zone"]
+                )
+            )
+            assert_that(
+                stats,
+                equal_to(
+                    [
+                        (("Midtown",), (2, [200.0, 300.0, 300.0])),
+                        (("Harlem",), (2, [400.0, 500.0, 500.0])),
+                        (("unknown",), (0, [None, None, None])),
+                    ]
+                ),
+            )
+
+
+class WriteToLocalSinkTest(unittest.TestCase):
+    NUM_ROWS = 10
+
+    def write_rows(self, sink, path):
+        # Every row is in its own window.
+        rows = [
+            TimestampedValue({"trips_last_5min": i, "time": str(i)}, i * 15)
+            for i in range(self.NUM_ROWS)
+        ]
+        with TestPipeline() as p:
+            _ = (
+                p
+                | beam.Create(rows)
+                | beam.WindowInto(window.SlidingWindows(size=30, period=15))
+                | streaming_count.WriteToLocalSink(
+                    sink, path, "traffic_realtime", batch_size=4
+                )
+            )
+
+    def test_ndjson(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.write_rows("ndjson", tmp)
+            lines = []
+            for path in glob.glob(os.path.join(tmp, "*.ndjson")):
+                with open(path, encoding="utf-8") as f:
+                    lines.extend(f.readlines())
+        # Two sliding windows per row.
+        self.assertEqual(len(lines), 2 * self.NUM_ROWS)
+
+    def test_parquet_files_hold_batches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.write_rows("parquet", tmp)
+            num_files = len(glob.glob(os.path.join(tmp, "*.parquet")))
+        self.assertLess(num_files, 2 * self.NUM_ROWS)
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "counts.db")
+            self.write_rows("sqlite", path)
+            with sqlite3.connect(path) as connection:
+                (count,) = connection.execute(
+                    "SELECT COUNT(*) FROM traffic_realtime"
+                ).fetchone()
+        self.assertEqual(count, 2 * self.NUM_ROWS)
+
+
+if __name__ == "__main__":
+    unittest.main()
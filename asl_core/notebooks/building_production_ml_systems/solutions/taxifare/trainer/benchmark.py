@@ -0,0 +1,641 @@
+"""Micro-benchmarks for the taxifare training code in `trainer.model`."""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import keras
+import tensorflow as tf
+from keras import callbacks
+from trainer import model, synthetic
+
+
+def benchmark_dataset(ds, num_batches, batch_size):
+    # The first batch pays for graph tracing and file opening, keep it out.
+    it = iter(ds)
+    next(it)
+    start = time.perf_counter()
+    steps = 0
+    for _ in range(num_batches):
+        try:
+            next(it)
+        except StopIteration:
+            break
+        steps += 1
+    elapsed = time.perf_counter() - start
+    return steps * batch_size / elapsed if elapsed > 0 else 0.0
+
+
+def run_input_pipeline(args):
+    results = {}
+    for input_pipeline in ["sequential", "parallel"]:
+        ds = model.create_dataset(
+            pattern=args.data_path,
+            batch_size=args.batch_size,
+            num_repeat=None,
+            mode="train",
+            input_pipeline=input_pipeline,
+            num_parallel_reads=args.num_parallel_reads,
+        )
+        results[input_pipeline] = benchmark_dataset(
+            ds, args.num_batches, args.batch_size
+        )
+        print(
+            f"{input_pipeline:>12}: {results[input_pipeline]:,.0f} examples/sec"
+        )
+
+    print(f"Speedup: {results['parallel'] / results['sequential']:.2f}x")
+    return results
+
+
+def run_parse(args):
+    # Lines are cached in memory first so that only parsing is timed.
+    files = tf.io.gfile.glob(args.data_path)
+    lines = tf.data.TextLineDataset(files).take(args.num_rows).cache()
+    for _ in lines.batch(args.batch_size):
+        pass
+
+    parsers = {
+        "parse_csv": lines.map(model.parse_csv).batch(args.batch_size),
+        "parse_csv_batch": lines.batch(args.batch_size).map(
+            model.parse_csv_batch
+        ),
+        "decode_csv_batch": lines.batch(args.batch_size).map(
+            model.decode_csv_batch
+        ),
+    }
+    results = {}
+    for name, ds in parsers.items():
+        results[name] = benchmark_dataset(
+            ds.repeat(), args.num_batches, args.batch_size
+        )
+        print(f"{name:>16}: {results[name]:,.0f} rows/sec")
+    return results
+
+
+def time_epoch(ds):
+    start = time.perf_counter()
+    for _ in ds:
+        pass
+    return time.perf_counter() - start
+
+
+def run_epoch(args):
+    start = time.perf_counter()
+    model.materialize_dataset(args.data_path, args.materialize_dir)
+    print(f"Materialization: {time.perf_counter() - start:.2f}s")
+
+    variants = {
+        "csv_sequential": dict(input_pipeline="sequential"),
+        "csv_parallel": dict(
+            input_pipeline="parallel", csv_decoder="decode_csv"
+        ),
+        "materialized": dict(materialize_dir=args.materialize_dir),
+    }
+    results = {}
+    for name, kwargs in variants.items():
+        ds = model.create_dataset(
+            pattern=args.data_path,
+            batch_size=args.batch_size,
+            num_repeat=1,
+            mode="train",
+            **kwargs,
+        )
+        results[name] = time_epoch(ds)
+        print(f"{name:>16}: {results[name]:.2f}s per epoch")
+    return results
+
+
+def synthetic_training_data(batch_size, num_rows=100000, seed=42):
+    # Coordinates spread around New York City, fares loosely tied to distance.
+    rng = tf.random.Generator.from_seed(seed)
+    plon = rng.normal([num_rows], mean=-73.98, stddev=0.04)
+    plat = rng.normal([num_rows], mean=40.75, stddev=0.03)
+    dlon = rng.normal([num_rows], mean=-73.98, stddev=0.04)
+    dlat = rng.normal([num_rows], mean=40.75, stddev=0.03)
+    distance = tf.sqrt((plon - dlon) ** 2 + (plat - dlat) ** 2)
+    fare = 2.5 + 150.0 * distance + rng.normal([num_rows], stddev=2.0)
+    ds = tf.data.Dataset.from_tensor_slices(((plon, plat, dlon, dlat), fare))
+    return ds.batch(batch_size, drop_remainder=True).cache().repeat()
+
+
+def synthetic_normalizers():
+    lat_scaler = keras.layers.Normalization(
+        axis=None, mean=40.75, variance=0.03**2
+    )
+    lon_scaler = keras.layers.Normalization(
+        axis=None, mean=-73.98, variance=0.04**2
+    )
+    return lat_scaler, lon_scaler
+
+
+def run_step_time(args):
+    # Per-step overhead is what matters for this small model: measure on CPU.
+    tf.config.set_visible_devices([], "GPU")
+    nnsize = [int(s) for s in args.nnsize.split()]
+    spe = args.steps_per_execution
+    variants = {
+        "baseline": dict(),
+        "jit_compile": dict(jit_compile=True),
+        f"steps_per_execution={spe}": dict(steps_per_execution=spe),
+        f"jit+steps_per_execution={spe}": dict(
+            jit_compile=True, steps_per_execution=spe
+        ),
+        "mixed_bfloat16": dict(mixed_precision="mixed_bfloat16"),
+    }
+    ds = synthetic_training_data(args.batch_size)
+
+    results = {}
+    for name, kwargs in variants.items():
+        # XLA needs the fused feature layer, which every variant uses so that
+        # only the option under test differs.
+        dnn = model.build_dnn_model(
+            args.nbuckets,
+            nnsize,
+            0.001,
+            synthetic_normalizers(),
+            feature_layer="fused",
+            **kwargs,
+        )
+        # Warm up: tracing and compilation are excluded from step time.
+        dnn.fit(ds, epochs=1, steps_per_epoch=2 * spe, verbose=0)
+        start = time.perf_counter()
+        dnn.fit(ds, epochs=1, steps_per_epoch=args.num_steps, verbose=0)
+        results[name] = (time.perf_counter() - start) / args.num_steps * 1000
+        print(f"{name:>30}: {results[name]:.3f} ms/step")
+    return results
+
+
+def run_serving_latency(args):
+    nnsize = [int(s) for s in args.nnsize.split()]
+    features, _ = next(iter(synthetic_training_data(max(args.batch_sizes))))
+
+    results = {}
+    for feature_layer in ["stack", "fused"]:
+        dnn = model.build_dnn_model(
+            args.nbuckets,
+            nnsize,
+            0.001,
+            synthetic_normalizers(),
+            feature_layer=feature_layer,
+        )
+        serve = tf.function(lambda x, dnn=dnn: dnn(x, training=False))
+        for batch_size in args.batch_sizes:
+            batch = [tf.reshape(f[:batch_size], [-1, 1]) for f in features]
+            serve(batch)  # trace once
+            start = time.perf_counter()
+            for _ in range(args.num_calls):
+                serve(batch)
+            latency = (time.perf_counter() - start) / args.num_calls * 1000
+            results[(feature_layer, batch_size)] = latency
+            print(
+                f"{feature_layer:>6} batch_size={batch_size:<6}: "
+                f"{latency:.3f} ms/call"
+            )
+    return results
+
+
+def run_embedding(args):
+    nnsize = [int(s) for s in args.nnsize.split()]
+    ds = synthetic_training_data(args.batch_size)
+    tmp_dir = tempfile.mkdtemp()
+
+    print(
+        f"{'cross_embedding':>20} {'params':>12} {'size (MB)':>10} "
+        f"{'examples/sec':>14}"
+    )
+    results = {}
+    for cross_embedding in ["full", "quotient_remainder", "multi_hash"]:
+        dnn = model.build_dnn_model(
+            args.nbuckets,
+            nnsize,
+            0.001,
+            synthetic_normalizers(),
+            feature_layer="fused",
+            cross_embedding=cross_embedding,
+            embedding_buckets=args.embedding_buckets,
+        )
+        dnn.fit(ds, epochs=1, steps_per_epoch=10, verbose=0)
+        start = time.perf_counter()
+        dnn.fit(ds, epochs=1, steps_per_epoch=args.num_steps, verbose=0)
+        elapsed = time.perf_counter() - start
+
+        path = os.path.join(tmp_dir, f"{cross_embedding}.keras")
+        dnn.save(path)
+        results[cross_embedding] = {
+            "params": dnn.count_params(),
+            "size_mb": os.path.getsize(path) / (1024 * 1024),
+            "examples_per_sec": args.num_steps * args.batch_size / elapsed,
+        }
+        row = results[cross_embedding]
+        print(
+            f"{cross_embedding:>20} {row['params']:>12,} "
+            f"{row['size_mb']:>10.2f} {row['examples_per_sec']:>14,.0f}"
+        )
+    return results
+
+
+def run_checkpoint(args):
+    ds = synthetic_training_data(args.batch_size)
+    variants = {
+        "sync, histogram_freq=1": dict(async_checkpoint=False, freq=1),
+        f"async, histogram_freq={args.histogram_freq}": dict(
+            async_checkpoint=True, freq=args.histogram_freq
+        ),
+    }
+    results = {}
+    for idx, (name, variant) in enumerate(variants.items()):
+        output_dir = os.path.join(args.output_dir, f"variant_{idx}")
+        checkpoint_path = os.path.join(output_dir, "checkpoint.keras")
+        if variant["async_checkpoint"]:
+            checkpoint_cb = model.AsyncModelCheckpoint(checkpoint_path)
+        else:
+            checkpoint_cb = callbacks.ModelCheckpoint(checkpoint_path)
+        tensorboard_cb = callbacks.TensorBoard(
+            os.path.join(output_dir, "tensorboard"),
+            histogram_freq=variant["freq"],
+        )
+        training_callbacks, stall_times = model.time_epoch_end(
+            [checkpoint_cb, tensorboard_cb]
+        )
+
+        dnn = model.build_dnn_model(
+            args.nbuckets, [32, 8], 0.001, synthetic_normalizers()
+        )
+        dnn.fit(
+            ds,
+            validation_data=ds.take(10),
+            epochs=args.num_epochs,
+            steps_per_epoch=args.steps_per_epoch,
+            callbacks=training_callbacks,
+            verbose=0,
+        )
+        results[name] = stall_times
+        print(
+            f"{name:>24}: {sum(stall_times) / len(stall_times):.3f}s "
+            f"mean stall per epoch"
+        )
+    return results
+
+
+def run_suite(args):
+    # End-to-end benchmark on synthetic data. Each run appends one JSON line
+    # to `results_path` so that runs can be compared for regressions.
+    data_dir = os.path.join(
+        args.work_dir,
+        f"synthetic_{args.num_rows}_{args.rows_per_shard}_{args.seed}",
+    )
+    start = time.perf_counter()
+    pattern = synthetic.generate_dataset(
+        data_dir, args.num_rows, args.rows_per_shard, seed=args.seed
+    )
+    metrics = {"generate_sec": time.perf_counter() - start}
+
+    evalds = model.create_dataset(
+        pattern,
+        args.batch_size,
+        num_repeat=1,
+        input_pipeline="parallel",
+        csv_decoder="decode_csv",
+    )
+    metrics["parse_rows_per_sec"] = args.num_rows / time_epoch(evalds)
+
+    start = time.perf_counter()
+    normalizers = model.adapt_normalize(pattern)
+    metrics["adapt_sec"] = time.perf_counter() - start
+
+    dnn = model.build_dnn_model(
+        args.nbuckets, [32, 8], 0.001, normalizers, feature_layer="fused"
+    )
+    trainds = model.create_dataset(
+        pattern,
+        args.batch_size,
+        num_repeat=None,
+        mode="train",
+        input_pipeline="parallel",
+        csv_decoder="decode_csv",
+    )
+    epoch_rows = min(args.num_rows, args.epoch_rows)
+    start = time.perf_counter()
+    dnn.fit(trainds, epochs=1, steps_per_epoch=epoch_rows // args.batch_size)
+    metrics["epoch_sec"] = time.perf_counter() - start
+    metrics["train_examples_per_sec"] = epoch_rows / metrics["epoch_sec"]
+
+    start = time.perf_counter()
+    model.export_serving_model(
+        dnn, os.path.join(tempfile.mkdtemp(), "savedmodel")
+    )
+    metrics["export_sec"] = time.perf_counter() - start
+
+    result = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "num_rows": args.num_rows,
+            "rows_per_shard": args.rows_per_shard,
+            "epoch_rows": epoch_rows,
+            "batch_size": args.batch_size,
+            "nbuckets": args.nbuckets,
+            "seed": args.seed,
+        },
+        "environment": {
+            "tensorflow": tf.__version__,
+            "keras": keras.__version__,
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+        },
+        "metrics": metrics,
+    }
+    with open(args.results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(json.dumps(metrics, indent=2))
+    return result
+
+
+def run_quantization(args):
+    tflite_path = args.tflite_path or os.path.join(
+        tempfile.mkdtemp(), "model_int8.tflite"
+    )
+    if not tf.io.gfile.exists(tflite_path):
+        model.export_tflite_model(args.saved_model_path, tflite_path)
+    report = model.compare_quantized_model(
+        args.saved_model_path,
+        tflite_path,
+        args.data_path,
+        num_rows=args.num_rows,
+        batch_sizes=args.batch_sizes,
+    )
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    input_parser = subparsers.add_parser(
+        "input_pipeline",
+        help="Compare examples/sec of the sequential and parallel pipelines",
+    )
+    input_parser.add_argument(
+        "--data_path", help="Location pattern of CSV files", required=True
+    )
+    input_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=512
+    )
+    input_parser.add_argument(
+        "--num_batches",
+        help="Number of batches to time per pipeline",
+        type=int,
+        default=200,
+    )
+    input_parser.add_argument(
+        "--num_parallel_reads",
+        help="Number of shards read concurrently by the parallel pipeline",
+        type=int,
+        default=None,
+    )
+    input_parser.set_defaults(func=run_input_pipeline)
+
+    parse_parser = subparsers.add_parser(
+        "parse", help="Compare rows/sec of the CSV parsing functions"
+    )
+    parse_parser.add_argument(
+        "--data_path", help="Location pattern of CSV files", required=True
+    )
+    parse_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=512
+    )
+    parse_parser.add_argument(
+        "--num_rows",
+        help="Number of rows loaded in memory for parsing",
+        type=int,
+        default=100000,
+    )
+    parse_parser.add_argument(
+        "--num_batches",
+        help="Number of batches to time per parser",
+        type=int,
+        default=200,
+    )
+    parse_parser.set_defaults(func=run_parse)
+
+    epoch_parser = subparsers.add_parser(
+        "epoch",
+        help="Compare the time of one pass over CSV and materialized data",
+    )
+    epoch_parser.add_argument(
+        "--data_path", help="Location pattern of CSV files", required=True
+    )
+    epoch_parser.add_argument(
+        "--materialize_dir",
+        help="Directory for the binary copy of the data",
+        required=True,
+    )
+    epoch_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=512
+    )
+    epoch_parser.set_defaults(func=run_epoch)
+
+    step_parser = subparsers.add_parser(
+        "step_time",
+        help="Compare training step time of the XLA, steps_per_execution "
+        "and mixed precision options on synthetic data",
+    )
+    step_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=32
+    )
+    step_parser.add_argument(
+        "--nbuckets", help="Number of buckets", type=int, default=10
+    )
+    step_parser.add_argument(
+        "--nnsize", help="Hidden layer sizes", default="32 8"
+    )
+    step_parser.add_argument(
+        "--num_steps",
+        help="Number of timed training steps per variant",
+        type=int,
+        default=2000,
+    )
+    step_parser.add_argument(
+        "--steps_per_execution",
+        help="Steps per execution of the corresponding variants",
+        type=int,
+        default=32,
+    )
+    step_parser.set_defaults(func=run_step_time)
+
+    serving_parser = subparsers.add_parser(
+        "serving_latency",
+        help="Compare inference latency of the layer stack and fused layer",
+    )
+    serving_parser.add_argument(
+        "--batch_sizes",
+        help="Request batch sizes",
+        type=int,
+        nargs="+",
+        default=[1, 64, 1024],
+    )
+    serving_parser.add_argument(
+        "--nbuckets", help="Number of buckets", type=int, default=10
+    )
+    serving_parser.add_argument(
+        "--nnsize", help="Hidden layer sizes", default="32 8"
+    )
+    serving_parser.add_argument(
+        "--num_calls",
+        help="Number of timed calls per batch size",
+        type=int,
+        default=1000,
+    )
+    serving_parser.set_defaults(func=run_serving_latency)
+
+    embedding_parser = subparsers.add_parser(
+        "embedding",
+        help="Report parameter count, size on disk and training throughput "
+        "of the feature cross embedding options",
+    )
+    embedding_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=256
+    )
+    embedding_parser.add_argument(
+        "--embedding_buckets",
+        help="Rows per table of the compressed embeddings",
+        type=int,
+        default=None,
+    )
+    embedding_parser.add_argument(
+        "--nbuckets", help="Number of buckets", type=int, default=20
+    )
+    embedding_parser.add_argument(
+        "--nnsize", help="Hidden layer sizes", default="32 8"
+    )
+    embedding_parser.add_argument(
+        "--num_steps",
+        help="Number of timed training steps per option",
+        type=int,
+        default=500,
+    )
+    embedding_parser.set_defaults(func=run_embedding)
+
+    checkpoint_parser = subparsers.add_parser(
+        "checkpoint",
+        help="Compare the per-epoch stall of synchronous checkpoints with "
+        "histograms against asynchronous checkpoints",
+    )
+    checkpoint_parser.add_argument(
+        "--output_dir",
+        help="Where checkpoints and TensorBoard logs are written, e.g. GCS",
+        required=True,
+    )
+    checkpoint_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=256
+    )
+    checkpoint_parser.add_argument(
+        "--histogram_freq",
+        help="Histogram frequency of the asynchronous variant",
+        type=int,
+        default=0,
+    )
+    checkpoint_parser.add_argument(
+        "--nbuckets", help="Number of buckets", type=int, default=20
+    )
+    checkpoint_parser.add_argument(
+        "--num_epochs", help="Number of epochs", type=int, default=5
+    )
+    checkpoint_parser.add_argument(
+        "--steps_per_epoch",
+        help="Training steps per epoch",
+        type=int,
+        default=100,
+    )
+    checkpoint_parser.set_defaults(func=run_checkpoint)
+
+    suite_parser = subparsers.add_parser(
+        "suite",
+        help="Measure parse throughput, adapt, epoch and export time on "
+        "synthetic data and append the results to a JSON lines file",
+    )
+    suite_parser.add_argument(
+        "--batch_size", help="Batch size", type=int, default=512
+    )
+    suite_parser.add_argument(
+        "--epoch_rows",
+        help="Maximum number of rows of the timed training epoch",
+        type=int,
+        default=1000000,
+    )
+    suite_parser.add_argument(
+        "--nbuckets", help="Number of buckets", type=int, default=10
+    )
+    suite_parser.add_argument(
+        "--num_rows",
+        help="Number of synthetic rows, e.g. 1000000 to 100000000",
+        type=int,
+        default=1000000,
+    )
+    suite_parser.add_argument(
+        "--results_path",
+        help="JSON lines file the results are appended to",
+        default="benchmark_results.jsonl",
+    )
+    suite_parser.add_argument(
+        "--rows_per_shard",
+        help="Number of rows per synthetic CSV shard",
+        type=int,
+        default=1000000,
+    )
+    suite_parser.add_argument(
+        "--seed", help="Seed of the synthetic data", type=int, default=42
+    )
+    suite_parser.add_argument(
+        "--work_dir",
+        help="Directory of the synthetic data, reused across runs",
+        required=True,
+    )
+    suite_parser.set_defaults(func=run_suite)
+
+    quantization_parser = subparsers.add_parser(
+        "quantization",
+        help="Compare size, latency and accuracy of an exported SavedModel "
+        "and its int8 TFLite version",
+    )
+    quantization_parser.add_argument(
+        "--batch_sizes",
+        help="Request batch sizes",
+        type=int,
+        nargs="+",
+        default=[1, 256],
+    )
+    quantization_parser.add_argument(
+        "--data_path",
+        help="Location pattern of labeled CSV files",
+        required=True,
+    )
+    quantization_parser.add_argument(
+        "--num_rows",
+        help="Number of rows used to measure accuracy",
+        type=int,
+        default=10000,
+    )
+    quantization_parser.add_argument(
+        "--saved_model_path",
+        help="SavedModel exported by the trainer with --feature_layer fused",
+        required=True,
+    )
+    quantization_parser.add_argument(
+        "--tflite_path",
+        help="Quantized model, converted from the SavedModel when missing",
+        default=None,
+    )
+    quantization_parser.set_defaults(func=run_quantization)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
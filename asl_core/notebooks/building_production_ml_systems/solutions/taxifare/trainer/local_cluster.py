@@ -0,0 +1,84 @@
+"""Runs `trainer.task` as a multi-worker cluster of local processes.
+
+Every argument not consumed here is forwarded to `trainer.task`, e.g.:
+
+    python -m trainer.local_cluster --num_workers 2 -- \
+        --train_data_path ... --eval_data_path ... --output_dir ...
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def pick_free_ports(num_ports):
+    sockets = []
+    for _ in range(num_ports):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def launch_workers(num_workers, task_args):
+    workers = [f"localhost:{port}" for port in pick_free_ports(num_workers)]
+    processes = []
+    for task_id in range(num_workers):
+        tf_config = {
+            "cluster": {"worker": workers},
+            "task": {"type": "worker", "index": task_id},
+        }
+        env = dict(os.environ, TF_CONFIG=json.dumps(tf_config))
+        cmd = [sys.executable, "-m", "trainer.task"] + task_args
+        cmd += ["--distribution", "multi_worker"]
+        processes.append(subprocess.Popen(cmd, env=env))
+
+    return wait_for_workers(processes)
+
+
+def wait_for_workers(processes, poll_secs=1.0, kill_timeout_secs=10.0):
+    # The other workers would wait for a failed one forever in collective
+    # ops, so they are terminated as soon as any worker fails.
+    while any(process.poll() is None for process in processes):
+        if any(process.poll() for process in processes):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=kill_timeout_secs)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            break
+        time.sleep(poll_secs)
+    return [process.returncode for process in processes]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_workers",
+        help="Number of worker processes to start on this machine",
+        type=int,
+        default=2,
+    )
+    args, task_args = parser.parse_known_args()
+    if task_args and task_args[0] == "--":
+        task_args = task_args[1:]
+
+    return_codes = launch_workers(args.num_workers, task_args)
+    print(f"Worker exit codes: {return_codes}")
+    # Negative codes are workers killed by a signal.
+    sys.exit(1 if any(return_codes) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Tests of `trainer.local_cluster`, run from the taxifare directory."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from trainer import local_cluster, synthetic
+
+
+def start_process(code):
+    return subprocess.Popen([sys.executable, "-c", code])
+
+
+class WaitForWorkersTest(unittest.TestCase):
+    def test_success(self):
+        processes = [start_process("pass") for _ in range(2)]
+        self.assertEqual(
+            local_cluster.wait_for_workers(processes, poll_secs=0.1), [0, 0]
+        )
+
+    def test_failure_terminates_survivors(self):
+        processes = [
+            start_process("import time; time.sleep(60)"),
+            start_process("raise SystemExit(3)"),
+        ]
+        start = time.perf_counter()
+        return_codes = local_cluster.wait_for_workers(processes, poll_secs=0.1)
+        self.assertLess(time.perf_counter() - start, 30)
+        self.assertLess(return_codes[0], 0)
+        self.assertEqual(return_codes[1], 3)
+
+
+class LaunchWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_multi_worker_training(self):
+        data_path = synthetic.generate_dataset(
+            os.path.join(self.tmp_dir, "data"), 2000, rows_per_shard=500
+        )
+        output_dir = os.path.join(self.tmp_dir, "output")
+        task_args = [
+            f"--train_data_path={data_path}",
+            f"--eval_data_path={data_path}",
+            f"--output_dir={output_dir}",
+            "--num_evals=1",
+            "--num_examples_to_train_on=640",
+            "--histogram_freq=0",
+            # Backed up by the chief, restored from by both workers.
+            "--resume",
+        ]
+        # The workers create their temporary directories under TMPDIR.
+        worker_tmp_dir = os.path.join(self.tmp_dir, "tmp")
+        os.makedirs(worker_tmp_dir)
+        with mock.patch.dict(os.environ, {"TMPDIR": worker_tmp_dir}):
+            return_codes = local_cluster.launch_workers(2, task_args)
+        self.assertEqual(return_codes, [0, 0])
+        self.assertEqual(os.listdir(worker_tmp_dir), [])
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "model.keras")))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, "backup")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,15 @@
 # pylint: skip-file
 
+import hashlib
+import json
 import logging
 import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
 
 import keras
 import numpy as np
@@ -19,6 +27,36 @@ from keras.layers import (
 )
 from keras.metrics import RootMeanSquaredError
 
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+CSV_COLUMNS = [
+    "fare_amount",
+    "pickup_datetime",
+    "pickup_longitude",
+    "pickup_latitude",
+    "dropoff_longitude",
+    "dropoff_latitude",
+    "passenger_count",
+    "key",
+]
+# fare_amount followed by the pickup/dropoff coordinates
+SELECTED_COLUMNS = [0, 2, 3, 4, 5]
+# No defaults: like `parse_csv`, decoding fails on a row with an empty value.
+# NumPy arrays, as creating tensors at import would start the TF runtime
+# before `create_strategy` can configure it.
+SELECTED_DEFAULTS = [np.zeros([0], np.float32)] * len(SELECTED_COLUMNS)
+# Rows sent for prediction have no fare_amount.
+SERVING_DEFAULTS = [[0.0]] + SELECTED_DEFAULTS[1:]
+INPUT_COLS = [
+    "pickup_longitude",
+    "pickup_latitude",
+    "dropoff_longitude",
+    "dropoff_latitude",
+]
+
 
 def parse_csv(row):
     ds = tf.strings.split(row, ",")
@@ -27,7 +65,53 @@ def parse_csv(row):
     return (feature[0], feature[1], feature[2], feature[3]), label
 
 
-def create_dataset(pattern, batch_size, num_repeat, mode="eval"):
+def parse_csv_batch(rows):
+    # Vectorized version of `parse_csv` operating on a whole batch of lines.
+    columns = tf.strings.split(rows, ",").to_tensor()
+    label = tf.strings.to_number(columns[:, 0])
+    feature = tf.strings.to_number(columns[:, 2:6])  # use some features only
+    return (feature[:, 0], feature[:, 1], feature[:, 2], feature[:, 3]), label
+
+
+def decode_csv_batch(rows, record_defaults=SELECTED_DEFAULTS):
+    # Decodes only the selected columns of a whole batch of lines at once.
+    label, plon, plat, dlon, dlat = tf.io.decode_csv(
+        rows, record_defaults=record_defaults, select_cols=SELECTED_COLUMNS
+    )
+    return (plon, plat, dlon, dlat), label
+
+
+BATCH_PARSERS = {
+    "split": parse_csv_batch,
+    "decode_csv": decode_csv_batch,
+}
+
+
+def create_dataset(
+    pattern,
+    batch_size,
+    num_repeat,
+    mode="eval",
+    input_pipeline="sequential",
+    num_parallel_reads=None,
+    csv_decoder="split",
+    materialize_dir=None,
+):
+    if materialize_dir:
+        files = materialize_dataset(pattern, materialize_dir)
+        return create_materialized_dataset(
+            files, batch_size, num_repeat, mode, num_parallel_reads
+        )
+    if input_pipeline == "parallel":
+        return create_parallel_dataset(
+            pattern,
+            batch_size,
+            num_repeat,
+            mode,
+            num_parallel_reads,
+            csv_decoder,
+        )
+
     ds = tf.data.Dataset.list_files(pattern)
     ds = ds.flat_map(tf.data.TextLineDataset)
     ds = ds.map(parse_csv)
@@ -37,6 +121,157 @@ def create_dataset(pattern, batch_size, num_repeat, mode="eval"):
     return ds
 
 
+def create_parallel_dataset(
+    pattern,
+    batch_size,
+    num_repeat,
+    mode="eval",
+    num_parallel_reads=None,
+    csv_decoder="split",
+):
+    # Reads shards concurrently, batches raw lines before parsing them with
+    # vectorized string ops, and overlaps input with training via prefetch.
+    num_parallel_reads = num_parallel_reads or tf.data.AUTOTUNE
+    training = mode == "train"
+
+    ds = tf.data.Dataset.list_files(pattern, shuffle=training)
+    ds = ds.interleave(
+        tf.data.TextLineDataset,
+        cycle_length=num_parallel_reads,
+        num_parallel_calls=num_parallel_reads,
+        deterministic=not training,
+    )
+    if training:
+        ds = ds.shuffle(buffer_size=1000)
+    ds = ds.repeat(num_repeat).batch(batch_size, drop_remainder=True)
+    ds = ds.map(
+        BATCH_PARSERS[csv_decoder],
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not training,
+    )
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def encode_block(rows):
+    # Stores a block of rows as one serialized float32 [rows, 5] tensor.
+    columns = tf.io.decode_csv(
+        rows, record_defaults=SELECTED_DEFAULTS, select_cols=SELECTED_COLUMNS
+    )
+    return tf.io.serialize_tensor(tf.stack(columns, axis=1))
+
+
+def decode_block(record):
+    # parse_tensor loses the static shape, which Keras needs to build.
+    block = tf.io.parse_tensor(record, out_type=tf.float32)
+    return tf.ensure_shape(block, [None, len(SELECTED_COLUMNS)])
+
+
+def split_columns(block):
+    return (block[:, 1], block[:, 2], block[:, 3], block[:, 4]), block[:, 0]
+
+
+def materialize_file(src_path, dst_path, block_rows=4096):
+    ds = tf.data.TextLineDataset(src_path).batch(block_rows).map(encode_block)
+    tmp_path = dst_path + ".tmp"
+    with tf.io.TFRecordWriter(tmp_path) as writer:
+        for record in ds:
+            writer.write(record.numpy())
+    tf.io.gfile.rename(tmp_path, dst_path, overwrite=True)
+
+
+def materialize_dataset(pattern, materialize_dir, num_workers=None):
+    # Converts CSV shards to TFRecord files of float32 column blocks, once.
+    # The cache lives in a directory keyed by `pattern` and is rebuilt when
+    # the fingerprint of the source files changes.
+    key = hashlib.sha256(pattern.encode()).hexdigest()[:16]
+    cache_dir = os.path.join(materialize_dir, key)
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    fingerprint = data_fingerprint(pattern)
+
+    if tf.io.gfile.exists(manifest_path):
+        with tf.io.gfile.GFile(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["fingerprint"] == fingerprint:
+            logging.info("Reusing materialized data in %s", cache_dir)
+            return [os.path.join(cache_dir, name) for name in manifest["files"]]
+        logging.info("Source files changed, rebuilding %s", cache_dir)
+        tf.io.gfile.rmtree(cache_dir)
+
+    tf.io.gfile.makedirs(cache_dir)
+    sources = sorted(tf.io.gfile.glob(pattern))
+    names = [f"part-{idx:05d}.tfrecord" for idx in range(len(sources))]
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        jobs = [
+            executor.submit(
+                materialize_file, src, os.path.join(cache_dir, name)
+            )
+            for src, name in zip(sources, names)
+        ]
+        for job in jobs:
+            job.result()
+
+    # The manifest is written last so an interrupted run is never reused.
+    manifest = {
+        "data_path": pattern,
+        "fingerprint": fingerprint,
+        "files": names,
+    }
+    with tf.io.gfile.GFile(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return [os.path.join(cache_dir, name) for name in names]
+
+
+def create_materialized_dataset(
+    files, batch_size, num_repeat, mode="eval", num_parallel_reads=None
+):
+    # Reads the binary blocks written by `materialize_dataset`, no parsing.
+    num_parallel_reads = num_parallel_reads or tf.data.AUTOTUNE
+    training = mode == "train"
+
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if training:
+        ds = ds.shuffle(len(files))
+    ds = ds.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=num_parallel_reads,
+        num_parallel_calls=num_parallel_reads,
+        deterministic=not training,
+    )
+    ds = ds.map(decode_block, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+    if training:
+        ds = ds.shuffle(buffer_size=1000)
+    ds = ds.repeat(num_repeat).batch(batch_size, drop_remainder=True)
+    ds = ds.map(split_columns, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def cache_dataset(
+    ds, pattern, cache="none", cache_dir=None, memory_budget_mb=1024
+):
+    # Caches a finite dataset after its first pass. The parsed data is never
+    # larger than the source CSV text, which bounds the in-memory footprint;
+    # above `memory_budget_mb` the cache falls back to local disk.
+    if cache == "none":
+        return ds
+    if cache == "memory":
+        size_mb = sum(
+            tf.io.gfile.stat(path).length for path in tf.io.gfile.glob(pattern)
+        ) / (1024 * 1024)
+        if size_mb <= memory_budget_mb:
+            return ds.cache().prefetch(tf.data.AUTOTUNE)
+        logging.warning(
+            "%s is %.0f MB, over the %d MB memory budget, caching on disk",
+            pattern,
+            size_mb,
+            memory_budget_mb,
+        )
+
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="taxifare_cache_")
+    tf.io.gfile.makedirs(cache_dir)
+    cache_path = os.path.join(cache_dir, f"cache_{os.getpid()}")
+    return ds.cache(cache_path).prefetch(tf.data.AUTOTUNE)
+
+
 def parse_lat_lon(row):
     columns = tf.strings.split(row, ",")
     # latitude idx: 3 and 5, longitude idx: 2 and 4
@@ -47,24 +282,170 @@ def parse_lat_lon(row):
     return lat_features, lon_features
 
 
-def adapt_normalize(train_data_path):
-    ds = tf.data.Dataset.list_files(train_data_path)
-    ds = ds.flat_map(tf.data.TextLineDataset)
-    lat_lon_ds = ds.map(parse_lat_lon).batch(10000)
+def column_moments(rows):
+    columns = tf.io.decode_csv(
+        rows, record_defaults=SELECTED_DEFAULTS, select_cols=SELECTED_COLUMNS
+    )
+    moments = {
+        CSV_COLUMNS[idx]: batch_moments(values)
+        for idx, values in zip(SELECTED_COLUMNS, columns)
+    }
+    # The normalizers share statistics between pickup and dropoff.
+    _, plon, plat, dlon, dlat = columns
+    moments["latitude"] = batch_moments(tf.concat([plat, dlat], axis=0))
+    moments["longitude"] = batch_moments(tf.concat([plon, dlon], axis=0))
+    return moments
+
+
+def batch_moments(values):
+    values = tf.cast(values, tf.float64)
+    count = tf.cast(tf.size(values), tf.float64)
+    mean = tf.reduce_mean(values)
+    m2 = tf.reduce_sum(tf.square(values - mean))
+    return count, mean, m2
+
+
+def merge_moments(left, right):
+    # Chan et al. parallel update of (count, mean, sum of squared deviations).
+    count_a, mean_a, m2_a = left
+    count_b, mean_b, m2_b = right
+    count = count_a + count_b
+    safe_count = tf.maximum(count, 1.0)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / safe_count
+    m2 = m2_a + m2_b + delta * delta * count_a * count_b / safe_count
+    return count, mean, m2
 
-    lat_scaler = keras.layers.Normalization(axis=None)
-    lon_scaler = keras.layers.Normalization(axis=None)
 
-    lat_values, lon_values = next(iter(lat_lon_ds))
+def compute_column_stats(pattern, max_rows=None, batch_size=10000):
+    # One streaming pass over all shards read in parallel. Per-batch moments
+    # are computed concurrently and merged, so memory use stays constant.
+    files = tf.io.gfile.glob(pattern)
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    ds = ds.interleave(
+        tf.data.TextLineDataset,
+        cycle_length=tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+    if max_rows:
+        ds = ds.take(max_rows)
+    ds = ds.batch(batch_size).map(
+        column_moments,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+
+    zero = tuple(tf.constant(0.0, dtype=tf.float64) for _ in range(3))
+    initial_state = {name: zero for name in ds.element_spec}
+    moments = ds.reduce(
+        initial_state,
+        lambda state, batch: {
+            name: merge_moments(state[name], batch[name]) for name in state
+        },
+    )
+
+    stats = {}
+    for name, (count, mean, m2) in moments.items():
+        count = float(count.numpy())
+        stats[name] = {
+            "count": int(count),
+            "mean": float(mean.numpy()),
+            "variance": float(m2.numpy()) / max(count, 1.0),
+        }
+    return stats
+
+
+def data_fingerprint(pattern):
+    # Fingerprints the matched files by path, size and modification time,
+    # which changes whenever a shard is rewritten, added or removed.
+    digest = hashlib.sha256()
+    for path in sorted(tf.io.gfile.glob(pattern)):
+        stat = tf.io.gfile.stat(path)
+        digest.update(f"{path}:{stat.length}:{stat.mtime_nsec}\n".encode())
+    return digest.hexdigest()
+
+
+def stats_cache_path(cache_dir, pattern, max_rows=None):
+    key = hashlib.sha256(f"{pattern}:{max_rows or 0}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"normalizer_stats_{key[:16]}.json")
+
+
+def read_stats_artifact(path, fingerprint, max_rows=None):
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        artifact = json.load(f)
+    if artifact.get("fingerprint") != fingerprint:
+        logging.info("Ignoring stale normalizer statistics in %s", path)
+        return None
+    if artifact.get("max_rows") != (max_rows or 0):
+        return None
+    return artifact
+
+
+def write_stats_artifact(path, artifact):
+    tf.io.gfile.makedirs(os.path.dirname(path))
+    with tf.io.gfile.GFile(path, "w") as f:
+        json.dump(artifact, f, indent=2)
 
-    lat_scaler.adapt(lat_values)
-    lon_scaler.adapt(lon_values)
 
-    print("Computed statistics for latitude:")
-    print(f"mean: {lat_scaler.mean}, variance: {lat_scaler.variance}")
+def load_normalizer_stats(
+    pattern, max_rows=None, cache_dir=None, output_dir=None
+):
+    # Statistics are looked up in `output_dir` first, then in the shared
+    # `cache_dir`, and only recomputed when the input files changed.
+    fingerprint = data_fingerprint(pattern)
+    candidates = []
+    if output_dir:
+        candidates.append(os.path.join(output_dir, "normalizer_stats.json"))
+    if cache_dir:
+        candidates.append(stats_cache_path(cache_dir, pattern, max_rows))
+
+    artifact, missing = None, []
+    for path in candidates:
+        artifact = read_stats_artifact(path, fingerprint, max_rows)
+        if artifact is not None:
+            logging.info("Reusing normalizer statistics from %s", path)
+            break
+        missing.append(path)
+
+    if artifact is None:
+        columns = compute_column_stats(pattern, max_rows)
+        artifact = {
+            "data_path": pattern,
+            "fingerprint": fingerprint,
+            "max_rows": max_rows or 0,
+            "row_count": columns[CSV_COLUMNS[0]]["count"],
+            "columns": columns,
+        }
+    for path in missing:
+        write_stats_artifact(path, artifact)
+    return artifact
+
+
+def adapt_normalize(
+    train_data_path, max_rows=None, cache_dir=None, output_dir=None
+):
+    stats = load_normalizer_stats(
+        train_data_path, max_rows, cache_dir, output_dir
+    )["columns"]
+    lat_stats, lon_stats = stats["latitude"], stats["longitude"]
+
+    lat_scaler = keras.layers.Normalization(
+        axis=None, mean=lat_stats["mean"], variance=lat_stats["variance"]
+    )
+    lon_scaler = keras.layers.Normalization(
+        axis=None, mean=lon_stats["mean"], variance=lon_stats["variance"]
+    )
+
+    print(f"Computed statistics for latitude over {lat_stats['count']} values:")
+    print(f"mean: {lat_stats['mean']}, variance: {lat_stats['variance']}")
     print("+++++")
-    print("Computed statistics for longitude:")
-    print(f"mean: {lon_scaler.mean}, variance: {lon_scaler.variance}")
+    print(
+        f"Computed statistics for longitude over {lon_stats['count']} values:"
+    )
+    print(f"mean: {lon_stats['mean']}, variance: {lon_stats['variance']}")
 
     return lat_scaler, lon_scaler
 
@@ -76,7 +457,247 @@ def euclidean(params):
     return tf.sqrt(londiff * londiff + latdiff * latdiff)
 
 
-def transform(inputs, nbuckets, normalizers):
+@keras.saving.register_keras_serializable(package="taxifare")
+class QREmbedding(keras.layers.Layer):
+    """Quotient-remainder embedding of ids in `[0, input_dim)`.
+
+    Each id is split into `id // num_buckets` and `id % num_buckets`, looked
+    up in two small tables and combined by element-wise product, which keeps
+    a unique embedding per id with about `2 * sqrt(input_dim)` rows when
+    `num_buckets` is close to `sqrt(input_dim)`.
+    """
+
+    def __init__(self, input_dim, output_dim, num_buckets, **kwargs):
+        super().__init__(**kwargs)
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.num_buckets = num_buckets
+
+    def build(self, input_shape):
+        self.quotient_embeddings = self.add_weight(
+            name="quotient_embeddings",
+            shape=(-(-self.input_dim // self.num_buckets), self.output_dim),
+            initializer="uniform",
+        )
+        self.remainder_embeddings = self.add_weight(
+            name="remainder_embeddings",
+            shape=(self.num_buckets, self.output_dim),
+            initializer="uniform",
+        )
+
+    def call(self, inputs):
+        ids = keras.ops.cast(inputs, "int64")
+        quotient = keras.ops.take(
+            self.quotient_embeddings, ids // self.num_buckets, axis=0
+        )
+        remainder = keras.ops.take(
+            self.remainder_embeddings, ids % self.num_buckets, axis=0
+        )
+        return quotient * remainder
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "input_dim": self.input_dim,
+                "output_dim": self.output_dim,
+                "num_buckets": self.num_buckets,
+            }
+        )
+        return config
+
+
+@keras.saving.register_keras_serializable(package="taxifare")
+class MultiHashEmbedding(keras.layers.Layer):
+    """Sums the embeddings of `num_hashes` independent hashes of each id.
+
+    Ids are hashed into `num_buckets` rows per table with fixed universal
+    hash functions, so two ids only share a full embedding when they collide
+    under every hash.
+    """
+
+    PRIME = 2**31 - 1
+
+    def __init__(
+        self, output_dim, num_buckets, num_hashes=2, seed=42, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.output_dim = output_dim
+        self.num_buckets = num_buckets
+        self.num_hashes = num_hashes
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.hash_params = [
+            (int(rng.integers(1, self.PRIME)), int(rng.integers(0, self.PRIME)))
+            for _ in range(num_hashes)
+        ]
+
+    def build(self, input_shape):
+        self.embeddings = [
+            self.add_weight(
+                name=f"embeddings_{idx}",
+                shape=(self.num_buckets, self.output_dim),
+                initializer="uniform",
+            )
+            for idx in range(self.num_hashes)
+        ]
+
+    def call(self, inputs):
+        # Ids are below 2**31 so the products fit in int64.
+        ids = keras.ops.cast(inputs, "int64") % self.PRIME
+        outputs = []
+        for (a, b), embeddings in zip(self.hash_params, self.embeddings):
+            hashed = ((a * ids + b) % self.PRIME) % self.num_buckets
+            outputs.append(keras.ops.take(embeddings, hashed, axis=0))
+        return keras.ops.sum(keras.ops.stack(outputs), axis=0)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "output_dim": self.output_dim,
+                "num_buckets": self.num_buckets,
+                "num_hashes": self.num_hashes,
+                "seed": self.seed,
+            }
+        )
+        return config
+
+
+def cross_embedding_layer(
+    input_dim, output_dim, cross_embedding="full", embedding_buckets=None
+):
+    if cross_embedding == "quotient_remainder":
+        num_buckets = embedding_buckets or int(np.ceil(np.sqrt(input_dim)))
+        return QREmbedding(input_dim, output_dim, num_buckets, name="pd_embed")
+    if cross_embedding == "multi_hash":
+        num_buckets = embedding_buckets or int(np.ceil(np.sqrt(input_dim)))
+        return MultiHashEmbedding(output_dim, num_buckets, name="pd_embed")
+    return Embedding(
+        input_dim=input_dim, output_dim=output_dim, name="pd_embed"
+    )
+
+
+@keras.saving.register_keras_serializable(package="taxifare")
+class FusedFeatures(keras.layers.Layer):
+    """Computes all the engineered taxifare features in a single layer.
+
+    Equivalent to the normalization, `euclidean`, `Discretization` and
+    pickup/dropoff crossing layers of `transform`, in one vectorized pass.
+    The four bucket indices are crossed by mixed-radix composition, which
+    yields collision-free ids in `[0, (nbuckets + 1) ** 4)` without hashing.
+
+    Returns the `[batch, 5]` float features (scaled pickup and dropoff
+    longitude and latitude, then distance) and the `[batch, 1]` cross ids.
+    """
+
+    def __init__(
+        self,
+        nbuckets,
+        lat_mean,
+        lat_variance,
+        lon_mean,
+        lon_variance,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.nbuckets = nbuckets
+        self.lat_mean = float(lat_mean)
+        self.lat_variance = float(lat_variance)
+        self.lon_mean = float(lon_mean)
+        self.lon_variance = float(lon_variance)
+        self.boundaries = np.linspace(start=-5, stop=5, num=nbuckets).tolist()
+
+    def call(self, inputs):
+        plon, plat, dlon, dlat = inputs
+        coords = keras.ops.concatenate([plon, dlon, plat, dlat], axis=-1)
+        mean = [self.lon_mean, self.lon_mean, self.lat_mean, self.lat_mean]
+        variance = [
+            self.lon_variance,
+            self.lon_variance,
+            self.lat_variance,
+            self.lat_variance,
+        ]
+        stddev = keras.ops.maximum(
+            keras.ops.sqrt(keras.ops.convert_to_tensor(variance)),
+            keras.backend.epsilon(),
+        )
+        scaled = (coords - keras.ops.convert_to_tensor(mean)) / stddev
+
+        # Columns of `scaled` are: plon, dlon, plat, dlat.
+        londiff = scaled[:, 1:2] - scaled[:, 0:1]
+        latdiff = scaled[:, 3:4] - scaled[:, 2:3]
+        distance = keras.ops.sqrt(londiff * londiff + latdiff * latdiff)
+
+        buckets = keras.ops.digitize(scaled, self.boundaries)
+        radix = self.nbuckets + 1
+        crossed = (
+            (buckets[:, 0:1] * radix + buckets[:, 2:3]) * radix
+            + buckets[:, 1:2]
+        ) * radix + buckets[:, 3:4]
+
+        features = keras.ops.concatenate([scaled, distance], axis=-1)
+        return features, crossed
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "nbuckets": self.nbuckets,
+                "lat_mean": self.lat_mean,
+                "lat_variance": self.lat_variance,
+                "lon_mean": self.lon_mean,
+                "lon_variance": self.lon_variance,
+            }
+        )
+        return config
+
+
+def fused_transform(
+    inputs,
+    nbuckets,
+    normalizers,
+    cross_embedding="full",
+    embedding_buckets=None,
+):
+    lat_config, lon_config = [layer.get_config() for layer in normalizers]
+    features, pd_fc = FusedFeatures(
+        nbuckets,
+        lat_mean=lat_config["mean"],
+        lat_variance=lat_config["variance"],
+        lon_mean=lon_config["mean"],
+        lon_variance=lon_config["variance"],
+        name="fused_features",
+    )(
+        [
+            inputs["pickup_longitude"],
+            inputs["pickup_latitude"],
+            inputs["dropoff_longitude"],
+            inputs["dropoff_latitude"],
+        ]
+    )
+
+    pd_embed = Flatten()(
+        cross_embedding_layer(
+            (nbuckets + 1) ** 4, 10, cross_embedding, embedding_buckets
+        )(pd_fc)
+    )
+    return Concatenate()([features, pd_embed])
+
+
+def transform(
+    inputs,
+    nbuckets,
+    normalizers,
+    feature_layer="stack",
+    cross_embedding="full",
+    embedding_buckets=None,
+):
+    if feature_layer == "fused":
+        return fused_transform(
+            inputs, nbuckets, normalizers, cross_embedding, embedding_buckets
+        )
+
     lat_scaler, lon_scaler = normalizers
 
     # Normalize longitude
@@ -114,8 +735,8 @@ def transform(inputs, nbuckets, normalizers):
 
     # Embedding with Embedding layer
     pd_embed = Flatten()(
-        Embedding(
-            input_dim=(nbuckets + 1) ** 4, output_dim=10, name="pd_embed"
+        cross_embedding_layer(
+            (nbuckets + 1) ** 4, 10, cross_embedding, embedding_buckets
         )(pd_fc)
     )
 
@@ -133,13 +754,22 @@ def transform(inputs, nbuckets, normalizers):
     return transformed
 
 
-def build_dnn_model(nbuckets, nnsize, lr, normalizers):
-    INPUT_COLS = [
-        "pickup_longitude",
-        "pickup_latitude",
-        "dropoff_longitude",
-        "dropoff_latitude",
-    ]
+def build_dnn_model(
+    nbuckets,
+    nnsize,
+    lr,
+    normalizers,
+    jit_compile=False,
+    steps_per_execution=1,
+    mixed_precision=None,
+    feature_layer="stack",
+    cross_embedding="full",
+    embedding_buckets=None,
+):
+    if jit_compile and feature_layer != "fused":
+        # Keras silently falls back to no XLA for the Discretization and
+        # HashedCrossing layers.
+        raise ValueError("jit_compile requires feature_layer='fused'")
 
     inputs = {
         colname: Input(name=colname, shape=(1,), dtype="float32")
@@ -147,22 +777,489 @@ def build_dnn_model(nbuckets, nnsize, lr, normalizers):
     }
 
     # transforms
-    x = transform(inputs, nbuckets, normalizers)
+    x = transform(
+        inputs,
+        nbuckets,
+        normalizers,
+        feature_layer,
+        cross_embedding,
+        embedding_buckets,
+    )
 
+    # Only the hidden layers use the mixed precision policy: coordinates
+    # lose too much precision in 16 bits, and the output stays in float32.
+    hidden_dtype = mixed_precision or "float32"
     for layer, nodes in enumerate(nnsize):
-        x = Dense(nodes, activation="relu", name=f"h{layer}")(x)
-    output = Dense(1, name="fare")(x)
+        x = Dense(
+            nodes, activation="relu", name=f"h{layer}", dtype=hidden_dtype
+        )(x)
+    output = Dense(1, name="fare", dtype="float32")(x)
 
     model = keras.Model(inputs=list(inputs.values()), outputs=output)
     # TODO 1a
     lr_optimizer = keras.optimizers.Adam(learning_rate=lr)
+    if mixed_precision == "mixed_float16":
+        lr_optimizer = keras.optimizers.LossScaleOptimizer(lr_optimizer)
     model.compile(
-        optimizer=lr_optimizer, loss="mse", metrics=[RootMeanSquaredError()]
+        optimizer=lr_optimizer,
+        loss="mse",
+        metrics=[RootMeanSquaredError()],
+        jit_compile=jit_compile,
+        steps_per_execution=steps_per_execution,
     )
 
     return model
 
 
+def export_serving_model(model, export_path):
+    # Besides the default signature taking one (batch, 1) tensor per input,
+    # exports signatures for packed (batch, 4) float32 arrays, columns in
+    # INPUT_COLS order, and for raw CSV lines in the training file layout
+    # (fare_amount may be empty), so bulk scoring needs no per-row work.
+    archive = keras.export.ExportArchive()
+    archive.track(model)
+    archive.add_endpoint(
+        name="serve",
+        fn=lambda inputs: model(inputs, training=False),
+        input_signature=[
+            [
+                tf.TensorSpec(shape=(None, 1), dtype=tf.float32, name=col)
+                for col in INPUT_COLS
+            ]
+        ],
+    )
+    archive.add_endpoint(
+        name="serve_packed",
+        fn=lambda features: model(
+            tf.split(features, len(INPUT_COLS), axis=1), training=False
+        ),
+        input_signature=[
+            tf.TensorSpec(
+                shape=(None, len(INPUT_COLS)), dtype=tf.float32, name="features"
+            )
+        ],
+    )
+    archive.add_endpoint(
+        name="serve_csv",
+        fn=lambda lines: model(
+            [
+                tf.expand_dims(col, 1)
+                for col in decode_csv_batch(lines, SERVING_DEFAULTS)[0]
+            ],
+            training=False,
+        ),
+        input_signature=[
+            tf.TensorSpec(shape=(None,), dtype=tf.string, name="lines")
+        ],
+    )
+    archive.write_out(export_path)
+
+
+def export_tflite_model(saved_model_path, tflite_path):
+    # Dynamic range quantization: weights, including the large pd_embed
+    # table, are stored as int8, activations stay in float.
+    converter = tf.lite.TFLiteConverter.from_saved_model(
+        saved_model_path, signature_keys=["serve_packed"]
+    )
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # Builtin ops only: the model must use feature_layer="fused", as the
+    # SparseCross op of the "stack" layer would need the Flex delegate.
+    tflite_model = converter.convert()
+    with tf.io.gfile.GFile(tflite_path, "wb") as f:
+        f.write(tflite_model)
+
+
+def directory_size(path):
+    return sum(
+        tf.io.gfile.stat(os.path.join(dirname, name)).length
+        for dirname, _, filenames in tf.io.gfile.walk(path)
+        for name in filenames
+    )
+
+
+def compare_quantized_model(
+    saved_model_path,
+    tflite_path,
+    data_path,
+    num_rows=10000,
+    batch_sizes=(1, 256),
+    num_calls=100,
+):
+    # Reports size, RMSE and per-call latency of the float SavedModel and
+    # the quantized TFLite model, both through their packed signature.
+    files = sorted(tf.io.gfile.glob(data_path))
+    lines = next(iter(tf.data.TextLineDataset(files).batch(num_rows)))
+    features, labels = decode_csv_batch(lines)
+    features = tf.stack(features, axis=1).numpy()
+    labels = labels.numpy()
+
+    serve_packed = tf.saved_model.load(saved_model_path).signatures[
+        "serve_packed"
+    ]
+    with tf.io.gfile.GFile(tflite_path, "rb") as f:
+        interpreter = tf.lite.Interpreter(model_content=f.read())
+    runner = interpreter.get_signature_runner("serve_packed")
+
+    def predict_float(batch):
+        outputs = serve_packed(features=tf.constant(batch))
+        return next(iter(outputs.values())).numpy()
+
+    def predict_int8(batch):
+        return next(iter(runner(features=batch).values()))
+
+    report = {
+        "float32": {"size_bytes": directory_size(saved_model_path)},
+        "int8": {"size_bytes": tf.io.gfile.stat(tflite_path).length},
+    }
+    predictions = {}
+    for name, predict in [("float32", predict_float), ("int8", predict_int8)]:
+        predictions[name] = np.concatenate(
+            [
+                predict(features[idx : idx + 1024]).reshape(-1)
+                for idx in range(0, len(features), 1024)
+            ]
+        )
+        rmse = np.sqrt(np.mean((predictions[name] - labels) ** 2))
+        report[name]["rmse"] = float(rmse)
+        for batch_size in batch_sizes:
+            batch = features[:batch_size]
+            predict(batch)
+            start = time.perf_counter()
+            for _ in range(num_calls):
+                predict(batch)
+            latency = (time.perf_counter() - start) / num_calls * 1000
+            report[name][f"latency_ms_batch_{batch_size}"] = latency
+
+    diff = np.abs(predictions["float32"] - predictions["int8"])
+    report["max_abs_prediction_diff"] = float(diff.max())
+    report["num_rows"] = int(len(labels))
+    return report
+
+
+class KerasMultiWorkerStrategy(tf.distribute.MultiWorkerMirroredStrategy):
+    """Multi-worker strategy whose `reduce` accepts what Keras passes it.
+
+    Keras reduces a whole nested input batch to build the model, which the
+    collective ops only accept one tensor at a time, and reduces the scalar
+    step logs along `axis=0`, which they do not have.
+    """
+
+    def reduce(self, reduce_op, value, axis):
+        reduce = super().reduce
+
+        def reduce_value(v):
+            rank = self.experimental_local_results(v)[0].shape.rank
+            return reduce(reduce_op, v, axis=axis if rank else None)
+
+        return tf.nest.map_structure(reduce_value, value)
+
+
+def create_strategy(distribution="default", num_cpu_devices=None):
+    # Must run before any other TF op, as it may split the host CPU into
+    # several logical devices for MirroredStrategy.
+    if distribution == "mirrored":
+        if num_cpu_devices and not tf.config.list_physical_devices("GPU"):
+            cpu = tf.config.list_physical_devices("CPU")[0]
+            tf.config.set_logical_device_configuration(
+                cpu, [tf.config.LogicalDeviceConfiguration()] * num_cpu_devices
+            )
+            devices = [d.name for d in tf.config.list_logical_devices("CPU")]
+            return tf.distribute.MirroredStrategy(devices)
+        return tf.distribute.MirroredStrategy()
+    if distribution == "multi_worker":
+        # Cluster membership is read from the TF_CONFIG environment variable.
+        return KerasMultiWorkerStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief(strategy):
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or resolver.task_type is None:
+        return True
+    if resolver.task_type == "chief":
+        return True
+    has_chief = "chief" in resolver.cluster_spec().as_dict()
+    is_first_worker = resolver.task_type == "worker" and resolver.task_id == 0
+    return is_first_worker and not has_chief
+
+
+def count_workers(strategy):
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None:
+        return 1
+    cluster = resolver.cluster_spec().as_dict()
+    return max(
+        1, len(cluster.get("chief", [])) + len(cluster.get("worker", []))
+    )
+
+
+def shard_by_file(ds, pattern, num_workers):
+    # Each worker reads a disjoint subset of the files; with fewer files than
+    # workers the elements are sharded instead.
+    options = tf.data.Options()
+    if len(tf.io.gfile.glob(pattern)) >= num_workers:
+        policy = tf.data.experimental.AutoShardPolicy.FILE
+    else:
+        logging.warning(
+            "%s has fewer files than workers, sharding by element", pattern
+        )
+        policy = tf.data.experimental.AutoShardPolicy.DATA
+    options.experimental_distribute.auto_shard_policy = policy
+    return ds.with_options(options)
+
+
+class AsyncModelCheckpoint(callbacks.Callback):
+    """Saves the model at every epoch end without waiting for slow storage.
+
+    The model is saved to a local temporary file on the training thread,
+    which is fast, and a background thread copies it to `filepath`, e.g. on
+    GCS. At most `max_pending` checkpoints wait for upload; beyond that the
+    training thread blocks until the writer catches up.
+    """
+
+    def __init__(self, filepath, max_pending=2):
+        super().__init__()
+        self.filepath = filepath
+        self.max_pending = max_pending
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._local_dir = None
+
+    def on_train_begin(self, logs=None):
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._local_dir = tempfile.mkdtemp(prefix="taxifare_checkpoint_")
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self._error is not None:
+            raise self._error
+        local_path = os.path.join(self._local_dir, f"epoch_{epoch}.keras")
+        self.model.save(local_path)
+        self._queue.put(local_path)
+
+    def on_train_end(self, logs=None):
+        self._queue.put(None)
+        self._thread.join()
+        tf.io.gfile.rmtree(self._local_dir)
+        if self._error is not None:
+            raise self._error
+
+    def _write_loop(self):
+        while True:
+            local_path = self._queue.get()
+            if local_path is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                tmp_path = self.filepath + ".tmp"
+                tf.io.gfile.makedirs(os.path.dirname(self.filepath))
+                tf.io.gfile.copy(local_path, tmp_path, overwrite=True)
+                tf.io.gfile.rename(tmp_path, self.filepath, overwrite=True)
+                logging.info("Saved checkpoint to %s", self.filepath)
+            except Exception as e:  # pylint: disable=broad-except
+                self._error = e
+            finally:
+                os.remove(local_path)
+
+
+class SharedBackupAndRestore(callbacks.BackupAndRestore):
+    """Backs up training from the chief only, restores every worker from it.
+
+    All workers then resume from the same epoch: restored from backups of
+    their own, they could run different numbers of steps and wait for each
+    other forever in collective ops.
+    """
+
+    def __init__(self, backup_dir, chief=True, **kwargs):
+        super().__init__(backup_dir, **kwargs)
+        self.chief = chief
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.chief:
+            super().on_epoch_end(epoch, logs)
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.chief:
+            super().on_train_batch_end(batch, logs)
+
+    def on_train_end(self, logs=None):
+        if self.chief:
+            super().on_train_end(logs)
+
+
+def time_epoch_end(training_callbacks):
+    # Brackets `training_callbacks` with timers measuring how long their
+    # `on_epoch_end` hooks (checkpointing, histograms...) stall training.
+    stall_times = []
+    start_times = {}
+
+    def start(epoch, logs):
+        start_times[epoch] = time.perf_counter()
+
+    def stop(epoch, logs):
+        stall_times.append(time.perf_counter() - start_times.pop(epoch))
+        print(
+            f"Epoch {epoch + 1} end callbacks stalled training for "
+            f"{stall_times[-1]:.3f}s"
+        )
+
+    timed_callbacks = (
+        [callbacks.LambdaCallback(on_epoch_end=start)]
+        + training_callbacks
+        + [callbacks.LambdaCallback(on_epoch_end=stop)]
+    )
+    return timed_callbacks, stall_times
+
+
+def resident_memory_mb():
+    # Current resident set size of this process, read from /proc on Linux,
+    # or None where it is unavailable.
+    if resource is None:
+        return None
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+
+def process_peak_memory_mb():
+    # Peak resident set size since the process started, or None where it is
+    # unavailable. ru_maxrss is in bytes on macOS, in kilobytes elsewhere.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class ThroughputMonitor(callbacks.Callback):
+    """Records training throughput and input pipeline wait per epoch.
+
+    Per epoch: examples/sec, step latency percentiles, the share of step
+    time spent waiting for the next batch of the dataset passed through
+    `instrument`, the largest resident host memory sampled after each step
+    and the peak host memory of the process so far, where the platform
+    exposes them. Results are written as
+    TensorBoard scalars under `log_dir` and as a JSON list to
+    `summary_path`. When `profile_steps` is a `(start, stop)` pair of global
+    steps, the TF profiler traces that window into `log_dir`.
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        log_dir,
+        summary_path,
+        steps_per_execution=1,
+        profile_steps=None,
+    ):
+        super().__init__()
+        self.examples_per_call = batch_size * steps_per_execution
+        self.steps_per_execution = steps_per_execution
+        self.log_dir = log_dir
+        self.summary_path = summary_path
+        self.profile_steps = profile_steps
+        self.epochs = []
+        self._delivered_at = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+        self._writer = None
+        self._global_step = 0
+        self._profiling = False
+
+    def instrument(self, ds):
+        # A map placed after the final prefetch runs when the training step
+        # pulls a batch, stamping the time the batch was actually delivered.
+        def stamp(*batch):
+            with tf.control_dependencies(
+                [self._delivered_at.assign(tf.timestamp())]
+            ):
+                return tf.nest.map_structure(tf.identity, batch)
+
+        return ds.map(stamp)
+
+    def on_train_begin(self, logs=None):
+        self._writer = tf.summary.create_file_writer(self.log_dir)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.time()
+        self._latencies = []
+        self._waits = []
+        self._memory = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and self._global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.log_dir)
+            self._profiling = True
+        self._step_start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.time()
+        latency = end - self._step_start
+        delivered_at = float(self._delivered_at.numpy())
+        self._latencies.append(latency)
+        # Only the last batch of a call is stamped, and it is pulled after
+        # the other steps of the call ran: spread the wait over the steps.
+        wait = max(0.0, delivered_at - self._step_start)
+        self._waits.append(min(latency, wait) / self.steps_per_execution)
+        memory_mb = resident_memory_mb()
+        if memory_mb is not None:
+            self._memory.append(memory_mb)
+
+        self._global_step += 1
+        if self._profiling and self._global_step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self._latencies:
+            return
+        train_time = max(sum(self._latencies), 1e-9)
+        input_wait = sum(self._waits)
+        num_examples = len(self._latencies) * self.examples_per_call
+        p50, p90, p99 = np.percentile(self._latencies, [50, 90, 99]) * 1000
+        stats = {
+            "epoch": epoch + 1,
+            "examples_per_sec": num_examples / train_time,
+            "step_latency_p50_ms": float(p50),
+            "step_latency_p90_ms": float(p90),
+            "step_latency_p99_ms": float(p99),
+            "input_wait_sec": input_wait,
+            "input_wait_fraction": input_wait / train_time,
+            "epoch_time_sec": time.time() - self._epoch_start,
+        }
+        # Host memory is only reported where the platform exposes it.
+        if self._memory:
+            stats["peak_host_memory_mb"] = max(self._memory)
+        process_peak_mb = process_peak_memory_mb()
+        if process_peak_mb is not None:
+            stats["process_peak_host_memory_mb"] = process_peak_mb
+        self.epochs.append(stats)
+
+        with self._writer.as_default(step=epoch):
+            for name, value in stats.items():
+                if name != "epoch":
+                    tf.summary.scalar(name, value)
+        self._writer.flush()
+
+        with tf.io.gfile.GFile(self.summary_path, "w") as f:
+            json.dump(self.epochs, f, indent=2)
+        logging.info(
+            "Epoch %d: %.0f examples/sec, %.1f%% of step time waiting on input",
+            epoch + 1,
+            stats["examples_per_sec"],
+            100 * stats["input_wait_fraction"],
+        )
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        self._writer.close()
+
+
 def train_and_evaluate(hparams):
     # TODO 1b
     batch_size = hparams["batch_size"]
@@ -174,47 +1271,186 @@ def train_and_evaluate(hparams):
     num_examples_to_train_on = hparams["num_examples_to_train_on"]
     output_dir = hparams["output_dir"]
     train_data_path = hparams["train_data_path"]
+    input_pipeline = hparams.get("input_pipeline", "sequential")
+    num_parallel_reads = hparams.get("num_parallel_reads")
+    csv_decoder = hparams.get("csv_decoder", "split")
+    normalizer_max_rows = hparams.get("normalizer_max_rows")
+    stats_cache_dir = hparams.get("stats_cache_dir")
+    materialize_dir = hparams.get("materialize_dir")
+    eval_cache = hparams.get("eval_cache", "none")
+    eval_cache_dir = hparams.get("eval_cache_dir")
+    eval_cache_memory_mb = hparams.get("eval_cache_memory_mb", 1024)
+    distribution = hparams.get("distribution", "default")
+    num_cpu_devices = hparams.get("num_cpu_devices")
+    jit_compile = hparams.get("jit_compile", False)
+    steps_per_execution = hparams.get("steps_per_execution", 1)
+    mixed_precision = hparams.get("mixed_precision")
+    feature_layer = hparams.get("feature_layer", "stack")
+    cross_embedding = hparams.get("cross_embedding", "full")
+    embedding_buckets = hparams.get("embedding_buckets")
+    resume = hparams.get("resume", False)
+    warm_start_path = hparams.get("warm_start_path")
+    async_checkpoint = hparams.get("async_checkpoint", False)
+    checkpoint_queue_size = hparams.get("checkpoint_queue_size", 2)
+    histogram_freq = hparams.get("histogram_freq", 1)
+    monitor_throughput = hparams.get("monitor_throughput", False)
+    profile_steps = hparams.get("profile_steps")
+    export_tflite = hparams.get("export_tflite", False)
+    if export_tflite and feature_layer != "fused":
+        # Checked before training, which would be wasted otherwise.
+        raise ValueError("export_tflite requires feature_layer='fused'")
+
+    strategy = create_strategy(distribution, num_cpu_devices)
+    num_workers = count_workers(strategy)
+    # `batch_size` is per replica, datasets are batched with the global size.
+    global_batch_size = batch_size * strategy.num_replicas_in_sync
+    # Under the shared `output_dir`, written by the chief and read by all.
+    backup_path = os.path.join(output_dir, "backup")
+    chief = is_chief(strategy)
+    worker_dir = None
+    if not chief:
+        # Only the chief writes to `output_dir`, other workers save to a
+        # throwaway location as required by multi-worker saving.
+        output_dir = worker_dir = tempfile.mkdtemp(prefix="taxifare_worker_")
 
     model_export_path = os.path.join(output_dir, "model.keras")
     serving_model_export_path = os.path.join(output_dir, "savedmodel")
     checkpoint_path = os.path.join(output_dir, "checkpoint.keras")
     tensorboard_path = os.path.join(output_dir, "tensorboard")
 
-    if tf.io.gfile.exists(output_dir):
+    if tf.io.gfile.exists(output_dir) and not resume:
         tf.io.gfile.rmtree(output_dir)
 
-    normalizers = adapt_normalize(eval_data_path)
-
-    model = build_dnn_model(nbuckets, nnsize, lr, normalizers)
+    with strategy.scope():
+        normalizers = adapt_normalize(
+            eval_data_path,
+            max_rows=normalizer_max_rows,
+            cache_dir=stats_cache_dir,
+            output_dir=output_dir,
+        )
+        model = build_dnn_model(
+            nbuckets,
+            nnsize,
+            lr,
+            normalizers,
+            jit_compile=jit_compile,
+            steps_per_execution=steps_per_execution,
+            mixed_precision=mixed_precision,
+            feature_layer=feature_layer,
+            cross_embedding=cross_embedding,
+            embedding_buckets=embedding_buckets,
+        )
+        if warm_start_path:
+            # The optimizer variables must exist for their state to load.
+            model.optimizer.build(model.trainable_variables)
+            model.load_weights(warm_start_path)
     logging.info(model.summary())
 
     trainds = create_dataset(
         pattern=train_data_path,
-        batch_size=batch_size,
+        batch_size=global_batch_size,
         num_repeat=None,
         mode="train",
+        input_pipeline=input_pipeline,
+        num_parallel_reads=num_parallel_reads,
+        csv_decoder=csv_decoder,
+        materialize_dir=materialize_dir,
     )
 
     evalds = create_dataset(
-        pattern=eval_data_path, batch_size=batch_size, num_repeat=1, mode="eval"
+        pattern=eval_data_path,
+        batch_size=global_batch_size,
+        num_repeat=1,
+        mode="eval",
+        input_pipeline=input_pipeline,
+        num_parallel_reads=num_parallel_reads,
+        csv_decoder=csv_decoder,
+        materialize_dir=materialize_dir,
+    )
+    if num_workers > 1:
+        trainds = shard_by_file(trainds, train_data_path, num_workers)
+        evalds = shard_by_file(evalds, eval_data_path, num_workers)
+    cache_dir = None
+    if eval_cache != "none":
+        # Every run caches into its own directory, removed after training.
+        if eval_cache_dir:
+            tf.io.gfile.makedirs(eval_cache_dir)
+        cache_dir = tempfile.mkdtemp(
+            prefix="taxifare_cache_", dir=eval_cache_dir
+        )
+    evalds = cache_dataset(
+        evalds,
+        pattern=eval_data_path,
+        cache=eval_cache,
+        cache_dir=cache_dir,
+        memory_budget_mb=eval_cache_memory_mb,
     )
 
-    steps_per_epoch = num_examples_to_train_on // (batch_size * num_evals)
-
-    checkpoint_cb = callbacks.ModelCheckpoint(checkpoint_path, verbose=1)
-    tensorboard_cb = callbacks.TensorBoard(tensorboard_path, histogram_freq=1)
+    steps_per_epoch = num_examples_to_train_on // (
+        global_batch_size * num_evals
+    )
 
-    history = model.fit(
-        trainds,
-        validation_data=evalds,
-        epochs=num_evals,
-        steps_per_epoch=max(1, steps_per_epoch),
-        verbose=2,  # 0=silent, 1=progress bar, 2=one line per epoch
-        callbacks=[checkpoint_cb, tensorboard_cb],
+    if async_checkpoint:
+        checkpoint_cb = AsyncModelCheckpoint(
+            checkpoint_path, max_pending=checkpoint_queue_size
+        )
+    else:
+        checkpoint_cb = callbacks.ModelCheckpoint(checkpoint_path, verbose=1)
+    tensorboard_cb = callbacks.TensorBoard(
+        tensorboard_path, histogram_freq=histogram_freq
     )
+    training_callbacks = [checkpoint_cb, tensorboard_cb]
+    if resume:
+        # Backs up model, optimizer and epoch counter at every epoch end and
+        # restores them when a preempted job is restarted, so at most one
+        # epoch of work is lost. The backup is deleted once training ends.
+        training_callbacks.insert(
+            0, SharedBackupAndRestore(backup_path, chief=chief)
+        )
+    training_callbacks, stall_times = time_epoch_end(training_callbacks)
+    if monitor_throughput or profile_steps:
+        throughput_cb = ThroughputMonitor(
+            batch_size=global_batch_size,
+            log_dir=os.path.join(tensorboard_path, "throughput"),
+            summary_path=os.path.join(output_dir, "throughput_summary.json"),
+            steps_per_execution=steps_per_execution,
+            profile_steps=profile_steps,
+        )
+        trainds = throughput_cb.instrument(trainds)
+        training_callbacks.append(throughput_cb)
+
+    try:
+        history = model.fit(
+            trainds,
+            validation_data=evalds,
+            epochs=num_evals,
+            steps_per_epoch=max(1, steps_per_epoch),
+            verbose=2,  # 0=silent, 1=progress bar, 2=one line per epoch
+            callbacks=training_callbacks,
+        )
+        print(
+            "Epoch end callbacks stalled training for "
+            f"{sum(stall_times):.3f}s in total"
+        )
 
-    # Save the Keras model file.
-    model.save(model_export_path)
-    # Exporting the model in savedmodel for serving.
-    model.export(serving_model_export_path)
+        # Save the Keras model file.
+        model.save(model_export_path)
+        # Exporting the model in savedmodel for serving.
+        export_serving_model(model, serving_model_export_path)
+        if export_tflite:
+            tflite_export_path = os.path.join(output_dir, "model_int8.tflite")
+            export_tflite_model(serving_model_export_path, tflite_export_path)
+            report = compare_quantized_model(
+                serving_model_export_path, tflite_export_path, eval_data_path
+            )
+            report_path = os.path.join(output_dir, "quantization_report.json")
+            with tf.io.gfile.GFile(report_path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Quantization report: {json.dumps(report, indent=2)}")
+    finally:
+        # Neither the eval cache nor what non-chief workers saved outlive
+        # the run.
+        for tmp_dir in [cache_dir, worker_dir]:
+            if tmp_dir and tf.io.gfile.exists(tmp_dir):
+                tf.io.gfile.rmtree(tmp_dir)
     return history
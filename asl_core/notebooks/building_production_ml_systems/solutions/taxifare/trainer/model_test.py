@@ -0,0 +1,463 @@
+"""Tests of `trainer.model`, run from the taxifare directory with pytest."""
+
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import keras
+import numpy as np
+import tensorflow as tf
+from trainer import model, synthetic
+
+# Pickup and dropoff longitude and latitude of a trip in Manhattan.
+INPUT_VALUES = [-73.99, 40.75, -73.97, 40.76]
+
+
+def build_small_model(feature_layer="fused"):
+    return model.build_dnn_model(
+        5,
+        [8],
+        0.001,
+        (
+            keras.layers.Normalization(axis=None, mean=40.75, variance=1),
+            keras.layers.Normalization(axis=None, mean=-73.98, variance=1),
+        ),
+        feature_layer=feature_layer,
+    )
+
+
+def fit_small_model(training_callback, epochs):
+    dnn = build_small_model()
+    features = [np.full((32, 1), value) for value in INPUT_VALUES]
+    return dnn.fit(
+        features, np.ones(32), epochs=epochs, callbacks=[training_callback]
+    )
+
+
+class TrainerTestCase(unittest.TestCase):
+    """Shares a small synthetic dataset between the tests of a class."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        cls.data_path = synthetic.generate_dataset(
+            os.path.join(cls.tmp_dir, "data"), 2000, rows_per_shard=500
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def hparams(self, **kwargs):
+        hparams = {
+            "batch_size": 32,
+            "nbuckets": 5,
+            "lr": 0.01,
+            "nnsize": "8",
+            "eval_data_path": self.data_path,
+            "train_data_path": self.data_path,
+            "num_evals": 1,
+            "num_examples_to_train_on": 640,
+            "output_dir": tempfile.mkdtemp(dir=self.tmp_dir),
+            "histogram_freq": 0,
+        }
+        hparams.update(kwargs)
+        return hparams
+
+
+class DecodeCsvTest(unittest.TestCase):
+    ROW = "12.5,2015-01-01 00:00:00 UTC,-73.99,40.75,-73.97,40.76,1,key"
+
+    def test_matches_parse_csv_batch(self):
+        rows = tf.constant([self.ROW] * 3)
+        features, label = model.decode_csv_batch(rows)
+        expected_features, expected_label = model.parse_csv_batch(rows)
+        np.testing.assert_array_equal(label, expected_label)
+        np.testing.assert_array_equal(features, expected_features)
+
+    def test_rejects_empty_values(self):
+        for column in [0, 2, 5]:
+            values = self.ROW.split(",")
+            values[column] = ""
+            rows = tf.constant([",".join(values)])
+            with self.subTest(column=column):
+                for parse in [model.decode_csv_batch, model.parse_csv_batch]:
+                    with self.assertRaises(tf.errors.InvalidArgumentError):
+                        parse(rows)
+                with self.assertRaises(tf.errors.InvalidArgumentError):
+                    model.column_moments(rows)
+
+    def test_serving_defaults_allow_empty_fare(self):
+        rows = tf.constant(["," + self.ROW.split(",", 1)[1]])
+        features, label = model.decode_csv_batch(rows, model.SERVING_DEFAULTS)
+        np.testing.assert_array_equal(label, [0.0])
+        np.testing.assert_allclose(
+            np.concatenate(features), INPUT_VALUES, rtol=1e-6
+        )
+
+
+class MaterializedDatasetTest(TrainerTestCase):
+    def dataset_rows(self, ds):
+        # Rows as (label, features...), sorted as file order is not kept.
+        rows = np.concatenate(
+            [np.stack((label,) + features, axis=1) for features, label in ds]
+        )
+        return rows[np.lexsort(rows.T[::-1])]
+
+    def test_matches_csv_dataset(self):
+        csv_ds = model.create_dataset(self.data_path, 100, num_repeat=1)
+        materialized_ds = model.create_dataset(
+            self.data_path,
+            100,
+            num_repeat=1,
+            materialize_dir=os.path.join(self.tmp_dir, "materialized"),
+        )
+        self.assertEqual(materialized_ds.element_spec[1].shape.as_list(), [100])
+        np.testing.assert_array_equal(
+            self.dataset_rows(materialized_ds), self.dataset_rows(csv_ds)
+        )
+
+    def test_train_and_evaluate(self):
+        hparams = self.hparams(
+            materialize_dir=os.path.join(self.tmp_dir, "materialized")
+        )
+        history = model.train_and_evaluate(hparams)
+        self.assertTrue(
+            math.isfinite(history.history["val_root_mean_squared_error"][-1])
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(hparams["output_dir"], "model.keras"))
+        )
+
+
+class EvalCacheTest(TrainerTestCase):
+    def test_disk_cache_is_removed(self):
+        eval_cache_dir = os.path.join(self.tmp_dir, "eval_cache")
+        model.train_and_evaluate(
+            self.hparams(
+                num_evals=2, eval_cache="disk", eval_cache_dir=eval_cache_dir
+            )
+        )
+        self.assertEqual(os.listdir(eval_cache_dir), [])
+
+
+class ExportTfliteTest(TrainerTestCase):
+    def test_quantization_report(self):
+        hparams = self.hparams(export_tflite=True, feature_layer="fused")
+        model.train_and_evaluate(hparams)
+        output_dir = hparams["output_dir"]
+        self.assertTrue(
+            os.path.exists(os.path.join(output_dir, "model_int8.tflite"))
+        )
+        with open(
+            os.path.join(output_dir, "quantization_report.json"),
+            encoding="utf-8",
+        ) as f:
+            report = json.load(f)
+        for name in ["float32", "int8"]:
+            self.assertEqual(
+                set(report[name]),
+                {
+                    "size_bytes",
+                    "rmse",
+                    "latency_ms_batch_1",
+                    "latency_ms_batch_256",
+                },
+            )
+            self.assertTrue(math.isfinite(report[name]["rmse"]))
+        self.assertLess(
+            report["int8"]["size_bytes"], report["float32"]["size_bytes"]
+        )
+
+    def test_requires_fused_features(self):
+        hparams = self.hparams(export_tflite=True, feature_layer="stack")
+        with self.assertRaises(ValueError):
+            model.train_and_evaluate(hparams)
+        # Rejected before training.
+        self.assertFalse(
+            os.path.exists(os.path.join(hparams["output_dir"], "model.keras"))
+        )
+
+
+class BuildDnnModelTest(unittest.TestCase):
+    def normalizers(self):
+        return (
+            keras.layers.Normalization(axis=None, mean=40.75, variance=1e-3),
+            keras.layers.Normalization(axis=None, mean=-73.98, variance=1e-3),
+        )
+
+    def test_jit_compile_requires_fused_features(self):
+        with self.assertRaises(ValueError):
+            model.build_dnn_model(
+                5, [8], 0.001, self.normalizers(), jit_compile=True
+            )
+
+    def test_jit_compile_is_kept(self):
+        dnn = model.build_dnn_model(
+            5,
+            [8],
+            0.001,
+            self.normalizers(),
+            jit_compile=True,
+            feature_layer="fused",
+        )
+        features = [np.full((32, 1), value) for value in INPUT_VALUES]
+        dnn.fit(features, np.ones(32), verbose=0)
+        self.assertTrue(dnn.jit_compile)
+
+
+class FusedFeaturesTest(unittest.TestCase):
+    NBUCKETS = 10
+    LAT_MEAN, LAT_VARIANCE = 40.75, 0.03**2
+    LON_MEAN, LON_VARIANCE = -73.98, 0.04**2
+
+    def normalizers(self):
+        return (
+            keras.layers.Normalization(
+                axis=None, mean=self.LAT_MEAN, variance=self.LAT_VARIANCE
+            ),
+            keras.layers.Normalization(
+                axis=None, mean=self.LON_MEAN, variance=self.LON_VARIANCE
+            ),
+        )
+
+    def inputs(self, num_rows=1000):
+        # Spread over more than the [-5, 5] bucket range in scaled units.
+        rng = np.random.default_rng(42)
+        plon, dlon = rng.normal(
+            self.LON_MEAN, 3 * self.LON_VARIANCE**0.5, (2, num_rows, 1)
+        )
+        plat, dlat = rng.normal(
+            self.LAT_MEAN, 3 * self.LAT_VARIANCE**0.5, (2, num_rows, 1)
+        )
+        return [v.astype(np.float32) for v in (plon, plat, dlon, dlat)]
+
+    def test_matches_layer_stack(self):
+        plon, plat, dlon, dlat = self.inputs()
+        features, crossed = model.FusedFeatures(
+            self.NBUCKETS,
+            lat_mean=self.LAT_MEAN,
+            lat_variance=self.LAT_VARIANCE,
+            lon_mean=self.LON_MEAN,
+            lon_variance=self.LON_VARIANCE,
+        )([plon, plat, dlon, dlat])
+
+        lat_scaler, lon_scaler = self.normalizers()
+        scaled_plon, scaled_dlon = lon_scaler(plon), lon_scaler(dlon)
+        scaled_plat, scaled_dlat = lat_scaler(plat), lat_scaler(dlat)
+        distance = model.euclidean(
+            [scaled_plon, scaled_plat, scaled_dlon, scaled_dlat]
+        )
+        np.testing.assert_allclose(
+            features,
+            np.concatenate(
+                [scaled_plon, scaled_dlon, scaled_plat, scaled_dlat, distance],
+                axis=1,
+            ),
+            atol=1e-5,
+        )
+
+        discretize = keras.layers.Discretization(
+            np.linspace(start=-5, stop=5, num=self.NBUCKETS).tolist()
+        )
+        buckets = [
+            np.asarray(discretize(scaled)).astype(np.int64)
+            for scaled in (scaled_plon, scaled_plat, scaled_dlon, scaled_dlat)
+        ]
+        radix = self.NBUCKETS + 1
+        expected = 0
+        for bucket in buckets:
+            expected = expected * radix + bucket
+        np.testing.assert_array_equal(crossed, expected)
+        self.assertGreater(len(np.unique(expected)), 100)
+
+    def test_save_and_load(self):
+        tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        dnn = model.build_dnn_model(
+            self.NBUCKETS,
+            [8],
+            0.001,
+            self.normalizers(),
+            feature_layer="fused",
+        )
+        path = os.path.join(tmp_dir, "model.keras")
+        dnn.save(path)
+        # No Lambda layer, so no need for safe_mode=False.
+        loaded = keras.models.load_model(path)
+        np.testing.assert_allclose(
+            loaded.predict(self.inputs(), verbose=0),
+            dnn.predict(self.inputs(), verbose=0),
+        )
+
+
+class CrossEmbeddingTest(unittest.TestCase):
+    def test_weights_are_created_in_build(self):
+        for cross_embedding in ["quotient_remainder", "multi_hash"]:
+            with self.subTest(cross_embedding=cross_embedding):
+                layer = model.cross_embedding_layer(10000, 4, cross_embedding)
+                self.assertEqual(layer.weights, [])
+                outputs = layer(np.array([[0], [9999]]))
+                self.assertEqual(outputs.shape, (2, 1, 4))
+                self.assertEqual(len(layer.trainable_weights), 2)
+                self.assertEqual(layer.count_params(), 2 * 100 * 4)
+
+    def test_save_and_load(self):
+        tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        ids = np.array([[0], [1234], [9999]])
+        for cross_embedding in ["quotient_remainder", "multi_hash"]:
+            with self.subTest(cross_embedding=cross_embedding):
+                inputs = keras.Input(shape=(1,), dtype="int64")
+                outputs = model.cross_embedding_layer(
+                    10000, 4, cross_embedding
+                )(inputs)
+                dnn = keras.Model(inputs, outputs)
+                path = os.path.join(tmp_dir, f"{cross_embedding}.keras")
+                dnn.save(path)
+                np.testing.assert_allclose(
+                    keras.models.load_model(path).predict(ids, verbose=0),
+                    dnn.predict(ids, verbose=0),
+                )
+
+
+class ExportServingModelTest(unittest.TestCase):
+    TRIPS = [
+        INPUT_VALUES,
+        [-73.78, 40.64, -73.98, 40.75],
+        [-74.01, 40.71, -73.87, 40.77],
+    ]
+
+    def test_endpoints_agree(self):
+        for feature_layer in ["stack", "fused"]:
+            with self.subTest(feature_layer=feature_layer):
+                export_path = tempfile.mkdtemp(prefix="taxifare_test_")
+                self.addCleanup(shutil.rmtree, export_path)
+                model.export_serving_model(
+                    build_small_model(feature_layer), export_path
+                )
+                reloaded = tf.saved_model.load(export_path)
+
+                trips = np.array(self.TRIPS, np.float32)
+                expected = reloaded.serve(
+                    [trips[:, i : i + 1] for i in range(trips.shape[1])]
+                )
+                # Rows to score have no fare_amount.
+                lines = [
+                    ",2015-01-01 00:00:00 UTC,"
+                    + ",".join(str(value) for value in trip)
+                    + ",1,key"
+                    for trip in self.TRIPS
+                ]
+                np.testing.assert_allclose(
+                    reloaded.serve_packed(trips), expected, rtol=1e-6
+                )
+                np.testing.assert_allclose(
+                    reloaded.serve_csv(tf.constant(lines)), expected, rtol=1e-6
+                )
+
+
+class SharedBackupAndRestoreTest(unittest.TestCase):
+    def read_backup_epoch(self, backup_dir):
+        with open(
+            os.path.join(backup_dir, "training_metadata.json"),
+            encoding="utf-8",
+        ) as f:
+            return json.load(f)["epoch"]
+
+    def test_workers_restore_the_chief_backup(self):
+        backup_dir = os.path.join(
+            tempfile.mkdtemp(prefix="taxifare_test_"), "backup"
+        )
+        self.addCleanup(shutil.rmtree, os.path.dirname(backup_dir))
+        fit_small_model(
+            model.SharedBackupAndRestore(
+                backup_dir, chief=True, delete_checkpoint=False
+            ),
+            epochs=2,
+        )
+        self.assertEqual(self.read_backup_epoch(backup_dir), 2)
+
+        history = fit_small_model(
+            model.SharedBackupAndRestore(backup_dir, chief=False), epochs=3
+        )
+        # Resumed from the chief's epoch, without writing or deleting it.
+        self.assertEqual(history.epoch, [2])
+        self.assertEqual(self.read_backup_epoch(backup_dir), 2)
+
+        history = fit_small_model(
+            model.SharedBackupAndRestore(backup_dir, chief=True), epochs=3
+        )
+        self.assertEqual(history.epoch, [2])
+        self.assertFalse(os.path.exists(backup_dir))
+
+
+class AsyncModelCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_saves_last_epoch(self):
+        filepath = os.path.join(self.tmp_dir, "checkpoints", "checkpoint.keras")
+        history = fit_small_model(
+            model.AsyncModelCheckpoint(filepath, max_pending=1), epochs=3
+        )
+        self.assertEqual(
+            os.listdir(os.path.dirname(filepath)), ["checkpoint.keras"]
+        )
+        checkpoint = keras.models.load_model(filepath)
+        self.assertEqual(int(checkpoint.optimizer.iterations), 3)
+        self.assertEqual(history.epoch, [0, 1, 2])
+
+    def test_writer_error_stops_training(self):
+        # The parent of the checkpoint is a file: the writer thread fails.
+        not_a_dir = os.path.join(self.tmp_dir, "not_a_dir")
+        with open(not_a_dir, "w", encoding="utf-8"):
+            pass
+        with self.assertRaises(tf.errors.OpError):
+            fit_small_model(
+                model.AsyncModelCheckpoint(
+                    os.path.join(not_a_dir, "checkpoint.keras")
+                ),
+                epochs=2,
+            )
+
+
+class ThroughputMonitorTest(TrainerTestCase):
+    def test_summary(self):
+        hparams = self.hparams(
+            num_evals=2, steps_per_execution=4, monitor_throughput=True
+        )
+        model.train_and_evaluate(hparams)
+        summary_path = os.path.join(
+            hparams["output_dir"], "throughput_summary.json"
+        )
+        with open(summary_path, encoding="utf-8") as f:
+            epochs = json.load(f)
+        self.assertEqual([stats["epoch"] for stats in epochs], [1, 2])
+        for stats in epochs:
+            self.assertLessEqual(stats["input_wait_fraction"], 1.0)
+            self.assertGreater(stats["peak_host_memory_mb"], 0)
+            self.assertLessEqual(
+                stats["peak_host_memory_mb"],
+                stats["process_peak_host_memory_mb"],
+            )
+
+    def test_skips_memory_where_unavailable(self):
+        tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        monitor = model.ThroughputMonitor(
+            32, tmp_dir, os.path.join(tmp_dir, "throughput_summary.json")
+        )
+        with mock.patch.object(model, "resource", None):
+            fit_small_model(monitor, epochs=1)
+        self.assertNotIn("peak_host_memory_mb", monitor.epochs[0])
+        self.assertNotIn("process_peak_host_memory_mb", monitor.epochs[0])
+        self.assertGreater(monitor.epochs[0]["examples_per_sec"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Bulk scoring of taxifare CSV shards with an exported SavedModel.
+
+Each input shard is scored into one output file holding one predicted fare
+per input line, in input order. Output files are written atomically, so an
+interrupted run can be restarted and only scores the remaining shards.
+"""
+
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent import futures
+
+import tensorflow as tf
+
+
+def read_batches(path, batch_size, batches):
+    # Runs in a reader thread, keeping up to `batches.maxsize` batches ahead.
+    try:
+        for lines in tf.data.TextLineDataset(path).batch(batch_size):
+            batches.put(lines)
+    except Exception as e:  # pylint: disable=broad-except
+        batches.put(e)
+        return
+    batches.put(None)
+
+
+def format_predictions(predictions):
+    values = tf.strings.as_string(tf.reshape(predictions, [-1]), precision=4)
+    return tf.strings.reduce_join(values, separator="\n").numpy() + b"\n"
+
+
+def score_shard(serve_csv, src_path, dst_path, batch_size, prefetch_batches):
+    batches = queue.Queue(maxsize=prefetch_batches)
+    reader = threading.Thread(
+        target=read_batches, args=(src_path, batch_size, batches), daemon=True
+    )
+    reader.start()
+
+    num_rows = 0
+    tmp_path = dst_path + ".tmp"
+    with tf.io.gfile.GFile(tmp_path, "wb") as f:
+        while True:
+            lines = batches.get()
+            if lines is None:
+                break
+            if isinstance(lines, Exception):
+                raise lines
+            outputs = serve_csv(lines=lines)
+            f.write(format_predictions(next(iter(outputs.values()))))
+            num_rows += int(lines.shape[0])
+    reader.join()
+    tf.io.gfile.rename(tmp_path, dst_path, overwrite=True)
+    return num_rows
+
+
+def output_path(output_dir, src_path):
+    return os.path.join(output_dir, os.path.basename(src_path) + ".pred")
+
+
+def predict(
+    model_dir,
+    input_path,
+    output_dir,
+    batch_size=8192,
+    num_workers=4,
+    prefetch_batches=4,
+):
+    serve_csv = tf.saved_model.load(model_dir).signatures["serve_csv"]
+    tf.io.gfile.makedirs(output_dir)
+
+    shards = sorted(tf.io.gfile.glob(input_path))
+    pending = [
+        src
+        for src in shards
+        if not tf.io.gfile.exists(output_path(output_dir, src))
+    ]
+    logging.info(
+        "Scoring %d shards, %d already done",
+        len(pending),
+        len(shards) - len(pending),
+    )
+
+    start = time.perf_counter()
+    total_rows = 0
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        jobs = {
+            executor.submit(
+                score_shard,
+                serve_csv,
+                src,
+                output_path(output_dir, src),
+                batch_size,
+                prefetch_batches,
+            ): src
+            for src in pending
+        }
+        for job in futures.as_completed(jobs):
+            total_rows += job.result()
+            elapsed = time.perf_counter() - start
+            logging.info(
+                "Scored %s, %d rows at %.0f rows/sec",
+                jobs[job],
+                total_rows,
+                total_rows / elapsed,
+            )
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = total_rows / elapsed if elapsed > 0 else 0.0
+    print(f"Scored {total_rows} rows in {elapsed:.1f}s")
+    print(f"Throughput: {rows_per_sec:,.0f} rows/sec")
+    return total_rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch_size",
+        help="Number of lines scored per model call",
+        type=int,
+        default=8192,
+    )
+    parser.add_argument(
+        "--input_path",
+        help="Location pattern of the CSV shards to score",
+        required=True,
+    )
+    parser.add_argument(
+        "--model_dir",
+        help="Exported SavedModel, i.e. the savedmodel dir of a training run",
+        required=True,
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of shards scored concurrently",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--output_dir",
+        help="Location of the prediction files; shards already scored there "
+        "are skipped",
+        required=True,
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        help="Number of batches each reader thread reads ahead",
+        type=int,
+        default=4,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    predict(**args.__dict__)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Tests of `trainer.predict`, run from the taxifare directory."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import keras
+import numpy as np
+import tensorflow as tf
+from trainer import model, predict, synthetic
+
+
+class PredictTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        cls.data_path = synthetic.generate_dataset(
+            os.path.join(cls.tmp_dir, "data"), 2000, rows_per_shard=500
+        )
+        dnn = model.build_dnn_model(
+            5,
+            [8],
+            0.001,
+            (
+                keras.layers.Normalization(axis=None, mean=40.75, variance=1),
+                keras.layers.Normalization(axis=None, mean=-73.98, variance=1),
+            ),
+            feature_layer="fused",
+        )
+        cls.model_dir = os.path.join(cls.tmp_dir, "savedmodel")
+        model.export_serving_model(dnn, cls.model_dir)
+        cls.serving_model = tf.saved_model.load(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+
+    def expected_predictions(self, shard):
+        with open(shard, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        return np.reshape(
+            self.serving_model.serve_csv(tf.constant(lines)), [-1]
+        )
+
+    def read_predictions(self, shard):
+        with open(
+            predict.output_path(self.output_dir, shard), encoding="utf-8"
+        ) as f:
+            return np.array([float(line) for line in f.read().splitlines()])
+
+    def test_one_prediction_per_line_in_order(self):
+        # Batches smaller than the shards, scored by concurrent workers.
+        num_rows = predict.predict(
+            self.model_dir,
+            self.data_path,
+            self.output_dir,
+            batch_size=64,
+            num_workers=2,
+            prefetch_batches=2,
+        )
+        self.assertEqual(num_rows, 2000)
+        shards = sorted(tf.io.gfile.glob(self.data_path))
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            [os.path.basename(shard) + ".pred" for shard in shards],
+        )
+        for shard in shards:
+            expected = self.expected_predictions(shard)
+            # Distinct per line, so that a reordering would be caught.
+            self.assertGreater(len(np.unique(expected)), 1)
+            np.testing.assert_allclose(
+                self.read_predictions(shard), expected, atol=1e-4
+            )
+
+    def test_skips_scored_shards(self):
+        shards = sorted(tf.io.gfile.glob(self.data_path))
+        scored_path = predict.output_path(self.output_dir, shards[0])
+        with open(scored_path, "w", encoding="utf-8") as f:
+            f.write("scored\n")
+        num_rows = predict.predict(
+            self.model_dir, self.data_path, self.output_dir
+        )
+        self.assertEqual(num_rows, 1500)
+        with open(scored_path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "scored\n")
+        self.assertEqual(len(self.read_predictions(shards[1])), 500)
+
+    def test_reader_error(self):
+        # A directory matching the input pattern cannot be read as lines.
+        input_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        os.makedirs(os.path.join(input_dir, "broken.csv"))
+        with self.assertRaises(tf.errors.OpError):
+            predict.predict(
+                self.model_dir,
+                os.path.join(input_dir, "*.csv"),
+                self.output_dir,
+            )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, "broken.csv.pred"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Deterministic synthetic taxi trips in the CSV layout of `trainer.model`.
+
+Rows follow `model.CSV_COLUMNS`. Each shard is generated from its own seed,
+so a dataset is identical whatever the number of workers, and shards are
+written in chunks so that memory use does not grow with the dataset size.
+"""
+
+import argparse
+import json
+import os
+from concurrent import futures
+
+import numpy as np
+import tensorflow as tf
+
+START_TIME = np.datetime64("2009-01-01T00:00:00")
+END_TIME = np.datetime64("2015-12-31T23:59:59")
+
+
+def generate_rows(rng, first_key, num_rows):
+    # Coordinates around Manhattan, fares growing with the trip distance.
+    plon = rng.normal(-73.975, 0.035, num_rows)
+    plat = rng.normal(40.751, 0.027, num_rows)
+    dlon = plon + rng.normal(0.0, 0.025, num_rows)
+    dlat = plat + rng.normal(0.0, 0.025, num_rows)
+    distance_km = np.abs(plon - dlon) * 84.0 + np.abs(plat - dlat) * 111.0
+    fare = np.maximum(
+        2.5, 2.5 + 1.56 * distance_km + rng.normal(0, 2, num_rows)
+    )
+
+    seconds = (END_TIME - START_TIME).astype(int)
+    pickup = START_TIME + rng.integers(0, seconds, num_rows).astype(
+        "timedelta64[s]"
+    )
+    pickup = np.char.replace(np.datetime_as_string(pickup), "T", " ")
+    passengers = rng.integers(1, 7, num_rows)
+    keys = np.arange(first_key, first_key + num_rows)
+
+    lines = tf.strings.join(
+        [
+            tf.strings.as_string(fare, precision=2),
+            tf.strings.join([pickup, " UTC"]),
+            tf.strings.as_string(plon, precision=6),
+            tf.strings.as_string(plat, precision=6),
+            tf.strings.as_string(dlon, precision=6),
+            tf.strings.as_string(dlat, precision=6),
+            tf.strings.as_string(passengers),
+            tf.strings.as_string(keys),
+        ],
+        separator=",",
+    )
+    return tf.strings.reduce_join(lines, separator="\n").numpy() + b"\n"
+
+
+def generate_shard(path, shard_index, first_key, num_rows, seed, chunk_rows):
+    rng = np.random.default_rng([seed, shard_index])
+    tmp_path = path + ".tmp"
+    with tf.io.gfile.GFile(tmp_path, "wb") as f:
+        for offset in range(0, num_rows, chunk_rows):
+            size = min(chunk_rows, num_rows - offset)
+            f.write(generate_rows(rng, first_key + offset, size))
+    tf.io.gfile.rename(tmp_path, path, overwrite=True)
+    return path
+
+
+def generate_dataset(
+    output_dir,
+    num_rows,
+    rows_per_shard=1000000,
+    seed=42,
+    num_workers=None,
+    chunk_rows=100000,
+    prefix="taxi-synthetic",
+):
+    # Returns the file pattern of the shards. The generation parameters are
+    # kept in a manifest: shards of other parameters are deleted, complete
+    # shards of the same parameters are kept, e.g. after an interruption.
+    tf.io.gfile.makedirs(output_dir)
+    num_shards = -(-num_rows // rows_per_shard)
+    names = [f"{prefix}-{shard:05d}.csv" for shard in range(num_shards)]
+    manifest = {
+        "num_rows": num_rows,
+        "rows_per_shard": rows_per_shard,
+        "seed": seed,
+        "chunk_rows": chunk_rows,
+        "files": names,
+    }
+    manifest_path = os.path.join(output_dir, f"{prefix}-manifest.json")
+    previous = None
+    if tf.io.gfile.exists(manifest_path):
+        with tf.io.gfile.GFile(manifest_path) as f:
+            previous = json.load(f)
+    pattern = os.path.join(output_dir, f"{prefix}-*.csv")
+    for path in tf.io.gfile.glob(pattern):
+        if previous != manifest or os.path.basename(path) not in names:
+            tf.io.gfile.remove(path)
+    with tf.io.gfile.GFile(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        jobs = []
+        for shard, name in enumerate(names):
+            path = os.path.join(output_dir, name)
+            if tf.io.gfile.exists(path):
+                continue
+            first_key = shard * rows_per_shard
+            size = min(rows_per_shard, num_rows - first_key)
+            jobs.append(
+                executor.submit(
+                    generate_shard,
+                    path,
+                    shard,
+                    first_key,
+                    size,
+                    seed,
+                    chunk_rows,
+                )
+            )
+        for job in jobs:
+            job.result()
+    return pattern
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_rows",
+        help="Total number of rows to generate",
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of shards generated concurrently",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--output_dir",
+        help="Directory of the generated CSV shards",
+        required=True,
+    )
+    parser.add_argument(
+        "--rows_per_shard",
+        help="Number of rows per CSV shard",
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "--seed", help="Seed of the generated data", type=int, default=42
+    )
+    args = parser.parse_args()
+
+    pattern = generate_dataset(
+        args.output_dir,
+        args.num_rows,
+        rows_per_shard=args.rows_per_shard,
+        seed=args.seed,
+        num_workers=args.num_workers,
+    )
+    print(f"Generated {args.num_rows} rows matching {pattern}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Tests of `trainer.synthetic`, run from the taxifare directory."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tensorflow as tf
+from trainer import synthetic
+
+
+def read_shards(pattern):
+    return {
+        os.path.basename(path): tf.io.gfile.GFile(path, "rb").read()
+        for path in tf.io.gfile.glob(pattern)
+    }
+
+
+class GenerateDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def test_reuses_shards_of_same_parameters(self):
+        pattern = synthetic.generate_dataset(
+            self.output_dir, 100, rows_per_shard=30
+        )
+        mtimes = {
+            path: os.path.getmtime(path) for path in tf.io.gfile.glob(pattern)
+        }
+        self.assertEqual(len(mtimes), 4)
+        synthetic.generate_dataset(self.output_dir, 100, rows_per_shard=30)
+        self.assertEqual(
+            {path: os.path.getmtime(path) for path in mtimes}, mtimes
+        )
+
+    def test_regenerates_shards_of_other_parameters(self):
+        for num_rows, rows_per_shard, seed in [
+            (100, 30, 42),
+            (100, 30, 7),
+            (100, 50, 7),
+            (40, 30, 7),
+        ]:
+            with self.subTest(
+                num_rows=num_rows, rows_per_shard=rows_per_shard, seed=seed
+            ):
+                pattern = synthetic.generate_dataset(
+                    self.output_dir, num_rows, rows_per_shard, seed=seed
+                )
+                expected_dir = tempfile.mkdtemp(dir=self.output_dir)
+                expected = synthetic.generate_dataset(
+                    expected_dir, num_rows, rows_per_shard, seed=seed
+                )
+                self.assertEqual(read_shards(pattern), read_shards(expected))
+                num_lines = sum(
+                    data.count(b"\n") for data in read_shards(pattern).values()
+                )
+                self.assertEqual(num_lines, num_rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
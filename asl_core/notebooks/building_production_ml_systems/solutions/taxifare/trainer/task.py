@@ -6,9 +6,15 @@ from trainer import model
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--async_checkpoint",
+        help="Upload the per-epoch checkpoint from a background thread "
+        "instead of blocking training",
+        action="store_true",
+    )
     parser.add_argument(
         "--batch_size",
-        help="Batch size for training steps",
+        help="Batch size for training steps, per replica",
         type=int,
         default=32,
     )
@@ -17,11 +23,127 @@ if __name__ == "__main__":
         help="GCS location pattern of eval files",
         required=True,
     )
+    parser.add_argument(
+        "--checkpoint_queue_size",
+        help="Maximum number of checkpoints waiting for the asynchronous "
+        "writer before training blocks",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--cross_embedding",
+        help="Embedding of the pickup/dropoff feature cross: 'full' has one "
+        "row per cross id, 'quotient_remainder' and 'multi_hash' use tables "
+        "of --embedding_buckets rows instead",
+        choices=["full", "quotient_remainder", "multi_hash"],
+        default="full",
+    )
+    parser.add_argument(
+        "--distribution",
+        help="Distribution strategy: 'mirrored' replicates the model over "
+        "the local devices, 'multi_worker' over the workers described by "
+        "TF_CONFIG. --batch_size is per replica",
+        choices=["default", "mirrored", "multi_worker"],
+        default="default",
+    )
+    parser.add_argument(
+        "--embedding_buckets",
+        help="Rows per table of the compressed cross embeddings (defaults "
+        "to the square root of the number of cross ids)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--eval_cache",
+        help="Cache the parsed eval dataset after the first validation pass: "
+        "'memory' keeps it in RAM (falling back to disk above "
+        "--eval_cache_memory_mb), 'disk' writes it to --eval_cache_dir",
+        choices=["none", "memory", "disk"],
+        default="none",
+    )
+    parser.add_argument(
+        "--eval_cache_dir",
+        help="Local directory under which each run writes its on-disk eval "
+        "cache, removed after training (defaults to the system temporary "
+        "directory)",
+        default=None,
+    )
+    parser.add_argument(
+        "--eval_cache_memory_mb",
+        help="Memory budget in MB for the in-memory eval cache",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--export_tflite",
+        help="Also export an int8 weight-quantized TFLite model and write a "
+        "size, latency and accuracy comparison to quantization_report.json; "
+        "requires --feature_layer fused",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--feature_layer",
+        help="Feature engineering implementation: 'stack' chains Lambda, "
+        "Discretization and HashedCrossing layers, 'fused' computes every "
+        "feature in one serializable FusedFeatures layer",
+        choices=["stack", "fused"],
+        default="stack",
+    )
+    parser.add_argument(
+        "--histogram_freq",
+        help="Epoch frequency of the TensorBoard weight histograms "
+        "(0 disables them)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--input_pipeline",
+        help="Input pipeline implementation: 'sequential' reads shards one "
+        "after another and parses row by row, 'parallel' interleaves shards, "
+        "parses whole batches with parallel calls and prefetches",
+        choices=["sequential", "parallel"],
+        default="sequential",
+    )
+    parser.add_argument(
+        "--num_parallel_reads",
+        help="Number of shards read concurrently by the parallel input "
+        "pipeline (defaults to tf.data.AUTOTUNE)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--csv_decoder",
+        help="Batch CSV decoder used by the parallel input pipeline: 'split' "
+        "tokenizes whole lines, 'decode_csv' decodes only the needed columns "
+        "with tf.io.decode_csv",
+        choices=["split", "decode_csv"],
+        default="split",
+    )
+    parser.add_argument(
+        "--monitor_throughput",
+        help="Record examples/sec, step latency percentiles, input wait and "
+        "host memory per epoch to TensorBoard and "
+        "throughput_summary.json in output_dir",
+        action="store_true",
+    )
     parser.add_argument(
         "--nnsize",
         help="Hidden layer sizes (provide space-separated sizes)",
         default="32 8",
     )
+    parser.add_argument(
+        "--jit_compile",
+        help="Compile the train and eval steps with XLA, requires "
+        "--feature_layer fused",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--materialize_dir",
+        help="Directory where CSV shards are converted once to binary "
+        "float32 TFRecord blocks and read back without parsing; the cache "
+        "is rebuilt when the source files change (disabled when not set)",
+        default=None,
+    )
     parser.add_argument(
         "--nbuckets",
         help="Number of buckets to divide lat and lon with",
@@ -31,6 +153,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "--lr", help="learning rate for optimizer", type=float, default=0.001
     )
+    parser.add_argument(
+        "--mixed_precision",
+        help="Mixed precision policy of the hidden layers; 'mixed_bfloat16' "
+        "is the one that speeds up CPUs",
+        choices=["mixed_float16", "mixed_bfloat16"],
+        default=None,
+    )
+    parser.add_argument(
+        "--normalizer_max_rows",
+        help="Maximum number of rows used to compute the latitude and "
+        "longitude normalization statistics (0 uses every row)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--num_cpu_devices",
+        help="Number of logical CPU devices the host CPU is split into for "
+        "the mirrored strategy when no GPU is available",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "--num_evals",
         help="Number of times to evaluate model on eval data training.",
@@ -48,11 +191,43 @@ if __name__ == "__main__":
         help="GCS location to write checkpoints and export models",
         required=True,
     )
+    parser.add_argument(
+        "--profile_steps",
+        help="Window of training steps traced by the TF profiler, as two "
+        "comma-separated global step numbers, e.g. '100,120'",
+        type=lambda steps: tuple(int(step) for step in steps.split(",")),
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Keep output_dir and resume training from the last epoch backed "
+        "up in it, e.g. after preemption, instead of starting from scratch",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--steps_per_execution",
+        help="Number of training steps run per compiled function call",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--stats_cache_dir",
+        help="Directory where normalization statistics are shared between "
+        "runs and reused while the input files are unchanged (disabled when "
+        "not set)",
+        default=None,
+    )
     parser.add_argument(
         "--train_data_path",
         help="GCS location pattern of train files containing eval URLs",
         required=True,
     )
+    parser.add_argument(
+        "--warm_start_path",
+        help="Keras model file saved by an earlier run with the same model "
+        "options, whose weights and optimizer state training continues from",
+        default=None,
+    )
     args = parser.parse_args()
     hparams = args.__dict__
 
@@ -0,0 +1,258 @@
+"""Local hyperparameter search for `trainer.model` with successive halving.
+
+Trials run in parallel worker processes. Normalizer statistics and the
+binary copy of the data are prepared once and shared by every trial. After
+each rung only the best `1 / reduction_factor` trials go on, continuing
+from their model of the previous rung until they have trained
+`reduction_factor` times more epochs. Results are written to
+`leaderboard.json` in the output directory after each rung, with a null
+metric and the error for failed trials.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+from concurrent import futures
+
+import tensorflow as tf
+from trainer import model
+
+METRIC = "val_root_mean_squared_error"
+
+
+def run_trial(hparams, num_threads):
+    # Keeps concurrent trials from oversubscribing the host cores.
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+    history = model.train_and_evaluate(hparams)
+    return float(history.history[METRIC][-1])
+
+
+def search_space(args):
+    grid = itertools.product(
+        args.nbuckets,
+        args.nnsize.split(";"),
+        args.lr,
+        args.batch_size,
+    )
+    trials = [
+        {"nbuckets": nbuckets, "nnsize": nnsize, "lr": lr, "batch_size": bs}
+        for nbuckets, nnsize, lr, bs in grid
+    ]
+    random.Random(args.seed).shuffle(trials)
+    return trials[: args.num_trials] if args.num_trials else trials
+
+
+def write_leaderboard(output_dir, leaderboard):
+    # Trials that reached later rungs, i.e. trained longer, rank first and
+    # failed trials, whose metric is null, last.
+    rows = sorted(
+        leaderboard.values(),
+        key=lambda row: (row[METRIC] is None, -row["rung"], row[METRIC] or 0),
+    )
+    with tf.io.gfile.GFile(
+        os.path.join(output_dir, "leaderboard.json"), "w"
+    ) as f:
+        json.dump(rows, f, indent=2, allow_nan=False)
+    return rows
+
+
+def tune(args):
+    if args.num_rungs < 1:
+        raise ValueError(f"num_rungs must be at least 1, got {args.num_rungs}")
+    tf.io.gfile.makedirs(args.output_dir)
+    shared_dir = os.path.join(args.output_dir, "shared")
+    stats_cache_dir = os.path.join(shared_dir, "stats")
+    materialize_dir = os.path.join(shared_dir, "data")
+
+    # Computed once here, then found in the shared caches by every trial.
+    model.load_normalizer_stats(args.eval_data_path, cache_dir=stats_cache_dir)
+    model.materialize_dataset(args.train_data_path, materialize_dir)
+    model.materialize_dataset(args.eval_data_path, materialize_dir)
+
+    num_cores = os.cpu_count() or 1
+    max_parallel = args.max_parallel or num_cores
+    num_threads = max(1, num_cores // max_parallel)
+
+    trials = [
+        dict(trial, trial_id=trial_id)
+        for trial_id, trial in enumerate(search_space(args))
+    ]
+    leaderboard = {}
+    trained_epochs, epochs = 0, args.min_epochs
+    for rung in range(args.num_rungs):
+        logging.info(
+            "Rung %d: training %d trials for %d more epochs",
+            rung,
+            len(trials),
+            epochs - trained_epochs,
+        )
+        # Spawned processes start with a fresh TF runtime each.
+        with futures.ProcessPoolExecutor(
+            max_workers=max_parallel,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            jobs = {}
+            for trial in trials:
+                trial_dir = os.path.join(
+                    args.output_dir, f"trial_{trial['trial_id']}"
+                )
+                hparams = {
+                    "batch_size": trial["batch_size"],
+                    "nbuckets": trial["nbuckets"],
+                    "lr": trial["lr"],
+                    "nnsize": trial["nnsize"],
+                    "eval_data_path": args.eval_data_path,
+                    "train_data_path": args.train_data_path,
+                    "num_evals": epochs - trained_epochs,
+                    "num_examples_to_train_on": args.examples_per_epoch
+                    * (epochs - trained_epochs),
+                    "output_dir": os.path.join(trial_dir, f"rung_{rung}"),
+                    "stats_cache_dir": stats_cache_dir,
+                    "materialize_dir": materialize_dir,
+                    "eval_cache": "memory",
+                    "histogram_freq": 0,
+                }
+                if rung:
+                    # Promoted trials continue from their previous rung.
+                    hparams["warm_start_path"] = os.path.join(
+                        trial_dir, f"rung_{rung - 1}", "model.keras"
+                    )
+                job = executor.submit(run_trial, hparams, num_threads)
+                jobs[job] = trial
+
+            for job in futures.as_completed(jobs):
+                trial = jobs[job]
+                row = dict(trial, rung=rung, epochs=epochs)
+                try:
+                    row[METRIC] = job.result()
+                    logging.info(
+                        "Trial %d: %s=%.4f",
+                        trial["trial_id"],
+                        METRIC,
+                        row[METRIC],
+                    )
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.exception("Trial %d failed", trial["trial_id"])
+                    row[METRIC] = None
+                    row["error"] = repr(e)
+                leaderboard[trial["trial_id"]] = row
+
+        rows = write_leaderboard(args.output_dir, leaderboard)
+        # Successive halving: only the best trials of this rung go on.
+        trials = sorted(
+            (
+                trial
+                for trial in trials
+                if leaderboard[trial["trial_id"]][METRIC] is not None
+            ),
+            key=lambda trial: leaderboard[trial["trial_id"]][METRIC],
+        )[: max(1, len(trials) // args.reduction_factor)]
+        if not trials:
+            break
+        trained_epochs, epochs = epochs, epochs * args.reduction_factor
+
+    best = rows[0]
+    if best[METRIC] is None:
+        raise RuntimeError(f"Every trial failed, see {args.output_dir}")
+    print(f"Best trial {best['trial_id']}: {METRIC}={best[METRIC]:.4f}")
+    print(json.dumps(best, indent=2))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch_size",
+        help="Batch sizes to try",
+        type=int,
+        nargs="+",
+        default=[32, 64],
+    )
+    parser.add_argument(
+        "--eval_data_path",
+        help="Location pattern of eval files",
+        required=True,
+    )
+    parser.add_argument(
+        "--examples_per_epoch",
+        help="Number of training examples per epoch",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--lr",
+        help="Learning rates to try",
+        type=float,
+        nargs="+",
+        default=[0.001, 0.01],
+    )
+    parser.add_argument(
+        "--max_parallel",
+        help="Number of trials run concurrently (defaults to the number of "
+        "cores)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--min_epochs",
+        help="Number of epochs of the first rung",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--nbuckets",
+        help="Numbers of buckets to try",
+        type=int,
+        nargs="+",
+        default=[10, 20],
+    )
+    parser.add_argument(
+        "--nnsize",
+        help="Hidden layer sizes to try, separated by ';', e.g. '32 8;64 16'",
+        default="32 8;64 16",
+    )
+    parser.add_argument(
+        "--num_rungs",
+        help="Number of successive halving rungs",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--num_trials",
+        help="Number of trials sampled from the grid (0 runs the full grid)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--output_dir",
+        help="Location of the trial outputs, shared caches and leaderboard",
+        required=True,
+    )
+    parser.add_argument(
+        "--reduction_factor",
+        help="Only 1 / reduction_factor of the trials go on to the next "
+        "rung, which trains reduction_factor times more epochs",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--seed", help="Seed of the trial sampling", type=int, default=42
+    )
+    parser.add_argument(
+        "--train_data_path",
+        help="Location pattern of train files",
+        required=True,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    tune(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Tests of `trainer.tune`, run from the taxifare directory."""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import keras
+from trainer import model, synthetic, tune
+
+
+class TuneTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="taxifare_test_")
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        data_path = synthetic.generate_dataset(
+            os.path.join(self.tmp_dir, "data"), 2000, rows_per_shard=500
+        )
+        self.args = argparse.Namespace(
+            batch_size=[32],
+            eval_data_path=data_path,
+            examples_per_epoch=320,
+            lr=[0.001, 0.01],
+            max_parallel=2,
+            min_epochs=1,
+            nbuckets=[5],
+            nnsize="8",
+            num_rungs=2,
+            num_trials=0,
+            output_dir=os.path.join(self.tmp_dir, "tune"),
+            reduction_factor=2,
+            seed=42,
+            train_data_path=data_path,
+        )
+
+    def test_successive_halving(self):
+        rows = tune.tune(self.args)
+        with open(
+            os.path.join(self.args.output_dir, "leaderboard.json"),
+            encoding="utf-8",
+        ) as f:
+            self.assertEqual(json.load(f), rows)
+
+        self.assertEqual([row["rung"] for row in rows], [1, 0])
+        self.assertEqual([row["epochs"] for row in rows], [2, 1])
+        for row in rows:
+            self.assertIsInstance(row[tune.METRIC], float)
+
+        # The promoted trial continued from its first rung: its optimizer
+        # ran the steps of both rungs.
+        best_model = keras.models.load_model(
+            os.path.join(
+                self.args.output_dir,
+                f"trial_{rows[0]['trial_id']}",
+                "rung_1",
+                "model.keras",
+            ),
+            custom_objects={"euclidean": model.euclidean},
+            safe_mode=False,
+        )
+        self.assertEqual(int(best_model.optimizer.iterations), 2 * 320 // 32)
+
+    def test_failed_trials(self):
+        self.args.num_rungs = 1
+        self.args.nnsize = "8;not_a_size"
+        self.args.lr = [0.01]
+        rows = tune.tune(self.args)
+        self.assertIsInstance(rows[0][tune.METRIC], float)
+        self.assertIsNone(rows[1][tune.METRIC])
+        self.assertIn("not_a_size", rows[1]["error"])
+
+    def test_rejects_no_rungs(self):
+        self.args.num_rungs = 0
+        with self.assertRaises(ValueError):
+            tune.tune(self.args)
+
+
+if __name__ == "__main__":
+    unittest.main()